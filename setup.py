@@ -30,10 +30,15 @@ setup(
         'Flask-Mako',
         'lxml'
     ],
+    extras_require={
+        'columnar': ['numpy'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
-    update_users_xml_local_file = presence_analyzer.config:get_user_xml
+    presence-benchmark = presence_analyzer.benchmark:main
+    presence-dataset = presence_analyzer.script:publish_dataset
+    update_users_xml_local_file = presence_analyzer.users_cron:main
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends of presence data used by views.
+"""
+import calendar
+from functools import wraps
+import json
+import sqlite3
+import threading
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import (
+    PresenceColumns,
+    day_events_between,
+    distribution,
+    get_date_index,
+    get_day_events,
+    get_group_weekday_summary,
+    get_heatmap,
+    get_presence_source,
+    get_user_weekday_stats,
+    get_weekday_stats,
+    memoize,
+    occupancy_table,
+    partition_paths,
+    percentile,
+    range_weekday_stats,
+    read_presence_tail,
+    seconds_since_midnight,
+    user_loading_enabled,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+BACKENDS = {}
+
+
+class StorageBackend(object):
+    """
+    Presence data access the views depend on.
+    """
+
+    def user_ids(self):
+        """
+        Returns sorted list of known user ids.
+        """
+        raise NotImplementedError
+
+    def weekday_stats(self, user_id, date_range=None, single_user=False,
+                      with_intervals=False):
+        """
+        Returns weekday statistics of user, as a row of
+        `utils.get_weekday_stats` table, or None for unknown users.
+
+        `date_range` is a pair of day ordinals (both inclusive) limiting
+        the entries. `single_user` tells that no other users' statistics
+        are going to be needed by the request. Sorted 'intervals' may be
+        left out unless `with_intervals` is set.
+        """
+        raise NotImplementedError
+
+    def bulk_weekday_stats(self, user_ids, date_range=None,
+                           with_intervals=False):
+        """
+        Returns weekday statistics of many users, as a dict mapping user
+        ids to `weekday_stats` results.
+        """
+        return dict(
+            (user_id, self.weekday_stats(
+                user_id, date_range, with_intervals=with_intervals,
+            ))
+            for user_id in user_ids
+        )
+
+    def group_weekday_summary(self, user_ids=None):
+        """
+        Returns weekday summary of given users (frozenset, None for all),
+        see `utils.get_group_weekday_summary`.
+        """
+        raise NotImplementedError
+
+    def heatmap(self, user_id=None, slot=3600):
+        """
+        Returns weekday occupancy table of user (all users for None), see
+        `utils.occupancy_table`, or None for unknown users.
+        """
+        raise NotImplementedError
+
+    def day_events(self, first_day, last_day):
+        """
+        Returns (day, starts, ends) of days with entries between given day
+        ordinals (both inclusive), see `utils.get_day_events`.
+        """
+        raise NotImplementedError
+
+
+class CsvBackend(StorageBackend):
+    """
+    Presence data read from DATA_CSV into memory.
+    """
+
+    def user_ids(self):
+        return sorted(get_presence_source().keys())
+
+    def weekday_stats(self, user_id, date_range=None, single_user=False,
+                      with_intervals=False):
+        if single_user and user_loading_enabled():
+            return get_user_weekday_stats(user_id, date_range)
+        if date_range is None:
+            return get_weekday_stats().get(user_id)
+        return range_weekday_stats(
+            get_date_index(), user_id, *date_range,
+            with_intervals=with_intervals
+        )
+
+    def bulk_weekday_stats(self, user_ids, date_range=None,
+                           with_intervals=False):
+        if date_range is None:
+            stats = get_weekday_stats()
+            return dict((user_id, stats.get(user_id)) for user_id in user_ids)
+        index = get_date_index()
+        return dict(
+            (user_id, range_weekday_stats(
+                index, user_id, *date_range, with_intervals=with_intervals
+            ))
+            for user_id in user_ids
+        )
+
+    def group_weekday_summary(self, user_ids=None):
+        return get_group_weekday_summary(user_ids)
+
+    def heatmap(self, user_id=None, slot=3600):
+        return get_heatmap(user_id, slot)
+
+    def day_events(self, first_day, last_day):
+        return day_events_between(get_day_events(), first_day, last_day)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    weekday INTEGER NOT NULL,
+    start_seconds INTEGER NOT NULL,
+    end_seconds INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+);
+CREATE INDEX IF NOT EXISTS presence_day ON presence (day);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+def _presence_values(rows):
+    """
+    Yields (user_id, day, weekday, start, end) table rows of parsed rows.
+    """
+    if isinstance(rows, PresenceColumns):
+        for user_id, date, start, end in rows:
+            yield user_id, date.toordinal(), date.weekday(), start, end
+        return
+    for user_id, date, start, end in rows:
+        yield (
+            user_id, date.toordinal(), date.weekday(),
+            seconds_since_midnight(start), seconds_since_midnight(end),
+        )
+
+
+@memoize(600, files=('DATA_CSV',))
+def import_csv(database):
+    """
+    Imports rows appended to DATA_CSV since the previous import into
+    SQLite database, all rows when the file was replaced.
+
+    Returns number of imported rows.
+    """
+    connection = sqlite3.connect(database, isolation_level=None)
+    try:
+        connection.executescript(SCHEMA)
+        # one importer at a time, readers are not blocked
+        connection.execute('BEGIN IMMEDIATE')
+        stored = connection.execute(
+            "SELECT value FROM meta WHERE key = 'csv_state'"
+        ).fetchone()
+        state = None
+        if stored is not None:
+            state = json.loads(stored[0])
+            state['identity'] = tuple(state['identity'])
+            state['last_line'] = state['last_line'].encode('latin-1')
+        rows, new_state, reloaded = read_presence_tail(
+            app.config['DATA_CSV'], state,
+        )
+        if reloaded:
+            connection.execute('DELETE FROM presence')
+        connection.executemany(
+            'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?, ?)',
+            _presence_values(rows),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('csv_state', ?)",
+            (json.dumps(dict(
+                new_state, last_line=new_state['last_line'].decode('latin-1'),
+            )),),
+        )
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+    if rows:
+        log.debug('Imported %d rows into %s', len(rows), database)
+    return len(rows)
+
+
+def _read_transaction(method):
+    """
+    Decorator - runs SQLite backend method on database brought up to date
+    once, with all its queries in one read transaction of the thread's
+    connection, so that they see the same rows even when an import
+    commits meanwhile.
+    """
+
+    @wraps(method)
+    def _method(self, *args, **kw):
+        """
+        Wraps method call in BEGIN and COMMIT.
+        """
+        connection = self._connection()  # pylint: disable=protected-access
+        connection.execute('BEGIN')
+        try:
+            return method(self, *args, **kw)
+        finally:
+            connection.execute('COMMIT')
+
+    return _method
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Presence data imported from DATA_CSV into indexed SQLite table, with
+    weekday aggregation done by SQL.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.local = threading.local()
+
+    def _connection(self):
+        """
+        Brings database up to date with CSV file and returns connection of
+        the current thread.
+        """
+        import_csv(self.database)
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # transactions are started explicitly by `_read_transaction`
+            connection = self.local.connection = sqlite3.connect(
+                self.database, isolation_level=None,
+            )
+        return connection
+
+    def _execute(self, query, parameters=()):
+        """
+        Runs the query in read transaction of the current thread.
+        """
+        return self.local.connection.execute(query, parameters)
+
+    def _select_users(self, user_ids):
+        """
+        Puts user ids into temporary table of the thread's connection and
+        returns condition matching their rows. Unlike query parameters,
+        it is not limited by SQLITE_MAX_VARIABLE_NUMBER.
+        """
+        connection = self.local.connection
+        connection.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS selected_users '
+            '(user_id INTEGER PRIMARY KEY)'
+        )
+        connection.execute('DELETE FROM selected_users')
+        connection.executemany(
+            'INSERT OR IGNORE INTO selected_users VALUES (?)',
+            ((user_id,) for user_id in user_ids),
+        )
+        return 'user_id IN (SELECT user_id FROM selected_users)'
+
+    @_read_transaction
+    def user_ids(self):
+        return [
+            user_id
+            for user_id, in self._execute(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+            )
+        ]
+
+    @_read_transaction
+    def weekday_stats(self, user_id, date_range=None, single_user=False,
+                      with_intervals=False):
+        # pylint: disable=unused-argument
+        return self._weekday_stats(
+            'user_id = ?', (user_id,), date_range, with_intervals,
+        ).get(user_id)
+
+    @_read_transaction
+    def bulk_weekday_stats(self, user_ids, date_range=None,
+                           with_intervals=False):
+        stats = self._weekday_stats(
+            self._select_users(user_ids), (), date_range, with_intervals,
+        )
+        return dict((user_id, stats.get(user_id)) for user_id in user_ids)
+
+    def _weekday_stats(self, users, parameters, date_range, with_intervals):
+        """
+        Returns weekday statistics of users matched by `users` condition,
+        computed by one aggregate query for all of them and, only
+        `with_intervals`, one ordered query of their intervals.
+        """
+        first, last = date_range or (0, 2 ** 31 - 1)
+        condition = 'WHERE ' + users + ' AND day BETWEEN ? AND ?'
+        parameters += (first, last)
+        stats = {}
+
+        def user_stats(user_id):
+            """
+            Returns (empty at first) statistics of user.
+            """
+            if user_id not in stats:
+                stats[user_id] = {
+                    'count': [0] * 7,
+                    'sum': [0] * 7,
+                    'mean': [0] * 7,
+                    'start': [0] * 7,
+                    'end': [0] * 7,
+                }
+                if with_intervals:
+                    stats[user_id]['intervals'] = [[] for _ in range(7)]
+            return stats[user_id]
+
+        if date_range is not None:
+            # known users without entries in range get empty statistics
+            for user_id, in self._execute(
+                    'SELECT DISTINCT user_id FROM presence WHERE ' + users,
+                    parameters[:-2]):
+                user_stats(user_id)
+
+        for user_id, day, count, total, start, end in self._execute(
+                'SELECT user_id, weekday, COUNT(*), '
+                'SUM(end_seconds - start_seconds), '
+                'AVG(start_seconds), AVG(end_seconds) '
+                'FROM presence ' + condition + ' GROUP BY user_id, weekday',
+                parameters):
+            row = user_stats(user_id)
+            row['count'][day] = count
+            row['sum'][day] = total
+            row['mean'][day] = float(total) / count
+            row['start'][day] = start
+            row['end'][day] = end
+
+        if not with_intervals:
+            return stats
+        for user_id, day, interval in self._execute(
+                'SELECT user_id, weekday, '
+                'end_seconds - start_seconds AS interval '
+                'FROM presence ' + condition +
+                ' ORDER BY user_id, weekday, interval',
+                parameters):
+            user_stats(user_id)['intervals'][day].append(interval)
+        return stats
+
+    @_read_transaction
+    def group_weekday_summary(self, user_ids=None):
+        condition = ''
+        if user_ids is not None:
+            condition = 'WHERE ' + self._select_users(user_ids)
+
+        summary = [
+            {
+                'weekday': calendar.day_abbr[day],
+                'count': 0,
+                'total': 0,
+                'mean': 0,
+                'median': 0.0,
+                'start': distribution([]),
+                'end': distribution([]),
+            }
+            for day in range(7)
+        ]
+        for day, count, total in self._execute(
+                'SELECT weekday, COUNT(*), '
+                'SUM(end_seconds - start_seconds) '
+                'FROM presence ' + condition + ' GROUP BY weekday'):
+            summary[day].update({
+                'count': count,
+                'total': total,
+                'mean': float(total) / count,
+            })
+
+        for name, expression in (
+                ('median', 'end_seconds - start_seconds'),
+                ('start', 'start_seconds'),
+                ('end', 'end_seconds')):
+            values = [[] for _ in range(7)]
+            for day, value in self._execute(
+                    'SELECT weekday, ' + expression + ' AS value '
+                    'FROM presence ' + condition + ' ORDER BY weekday, value'):
+                values[day].append(value)
+            for day in range(7):
+                if name == 'median':
+                    summary[day]['median'] = percentile(values[day], 50)
+                else:
+                    summary[day][name] = distribution(values[day])
+        return summary
+
+    @_read_transaction
+    def heatmap(self, user_id=None, slot=3600):
+        condition = ''
+        parameters = ()
+        if user_id is not None:
+            condition = 'WHERE user_id = ?'
+            parameters = (user_id,)
+        entries = self._execute(
+            'SELECT weekday, start_seconds, end_seconds FROM presence ' +
+            condition, parameters,
+        ).fetchall()
+        if user_id is not None and not entries:
+            return None
+        return occupancy_table(entries, slot)
+
+    @_read_transaction
+    def day_events(self, first_day, last_day):
+        days = []
+        for day, start, end in self._execute(
+                'SELECT day, start_seconds, end_seconds FROM presence '
+                'WHERE day BETWEEN ? AND ? AND end_seconds > start_seconds '
+                'ORDER BY day', (first_day, last_day)):
+            if not days or days[-1][0] != day:
+                days.append((day, [], []))
+            days[-1][1].append(start)
+            days[-1][2].append(end)
+        return [
+            (day, sorted(starts), sorted(ends))
+            for day, starts, ends in days
+        ]
+
+
+def get_backend():
+    """
+    Returns storage backend chosen by STORAGE_BACKEND config key: 'csv'
+    (default) or 'sqlite', which keeps its database in SQLITE_DATABASE
+    (next to DATA_CSV by default).
+    """
+    name = app.config.get('STORAGE_BACKEND', 'csv')
+    if name == 'csv':
+        key = (name,)
+    elif name == 'sqlite':
+        if partition_paths(app.config['DATA_CSV']) is not None:
+            raise ValueError('SQLite backend needs single DATA_CSV file')
+        key = (name, app.config.get(
+            'SQLITE_DATABASE', app.config['DATA_CSV'] + '.sqlite',
+        ))
+    else:
+        raise ValueError('Unknown storage backend {0!r}'.format(name))
+    backend = BACKENDS.get(key)
+    if backend is None:
+        backend = BACKENDS[key] = (
+            CsvBackend() if name == 'csv' else SQLiteBackend(key[1])
+        )
+    return backend
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of presence data parsing, data models and API endpoints.
+
+Usage: python -m presence_analyzer.benchmark [--users 100] [--years 2]
+           [--csv path/to/data.csv] [--requests 20] [--output result.json]
+
+Without --csv synthetic presence CSV and users XML of given size are
+generated. Results are printed (or written to --output) as JSON.
+"""
+import argparse
+import csv
+import datetime
+import json
+import multiprocessing
+import os.path
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from presence_analyzer import utils
+from presence_analyzer.main import app
+from presence_analyzer.store import PresenceStore, numpy
+
+ENDPOINTS = [
+    '/api/v1/users',
+    '/api/v1/users_data',
+    '/api/v1/mean_time_weekday/{user_id}',
+    '/api/v1/presence_weekday/{user_id}',
+    '/api/v1/presence_start_end/{user_id}',
+    '/api/v1/median_weekday/{user_id}',
+    '/api/v1/percentiles_weekday/{user_id}?bin_width=900',
+    '/api/v1/bulk/mean_time_weekday',
+    '/api/v1/group_weekday',
+    '/api/v1/heatmap/{user_id}',
+    '/api/v1/heatmap?resolution=quarter',
+    '/api/v1/occupancy/{day}',
+    '/api/v1/occupancy',
+    '/api/v1/cache_stats',
+    '/api/v1/metrics',
+]
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Approximates memory used by object together with objects it refers to.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, PresenceStore):
+        size += obj.nbytes + deep_sizeof(getattr(obj, '_index'), seen)
+    elif isinstance(obj, dict):
+        size += sum(
+            deep_sizeof(key, seen) + deep_sizeof(value, seen)
+            for key, value in obj.iteritems()
+        )
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(
+            deep_sizeof(getattr(obj, name), seen) for name in obj.__slots__
+        )
+    return size
+
+
+def timed(function, *args):
+    """
+    Returns (result, seconds) of a single function call.
+    """
+    started = time.time()
+    result = function(*args)
+    return result, time.time() - started
+
+
+def forget_loaded_data():
+    """
+    Drops all cached and incrementally loaded data, like a process restart.
+    """
+    utils.CACHE_TIMESTAMP.clear()
+    utils.TAIL_STATE.clear()
+    utils.PARTITION_STATE.clear()
+    utils.DERIVED_DATA.clear()
+    with utils.RESPONSE_CACHE_LOCK:
+        utils.RESPONSE_CACHE.clear()
+        utils.RESPONSE_CACHE_STATS.update(
+            dict.fromkeys(utils.RESPONSE_CACHE_STATS, 0),
+        )
+
+
+def _fresh(loader):
+    """
+    Calls memoized loader bypassing its cache.
+    """
+    forget_loaded_data()
+    return loader()
+
+
+def _dict_stats(data, user_id):
+    """
+    Computes all four per-user statistics on the dict model.
+    """
+    weekdays = utils.group_by_weekday(data[user_id])
+    week = utils.group_start_end_times_by_weekday(data[user_id])
+    return (
+        [utils.mean(intervals) for intervals in weekdays],
+        [sum(intervals) for intervals in weekdays],
+        [utils.median(intervals) for intervals in weekdays],
+        [(utils.mean(week[day]['start']), utils.mean(week[day]['end']))
+         for day in week],
+    )
+
+
+def _store_stats(store, user_id):
+    """
+    Computes all four per-user statistics on the columnar store.
+    """
+    return (
+        store.weekday_means(user_id),
+        store.weekday_sums(user_id),
+        store.weekday_medians(user_id),
+        store.weekday_start_end_means(user_id),
+    )
+
+
+def compare_models(csv_path):
+    """
+    Returns load time, memory and statistics latency of both data models.
+    """
+    app.config.update({
+        'DATA_CSV': csv_path,
+        'COLUMNAR_STORE': True,
+        'DATA_SNAPSHOT': False,
+    })
+    data, dict_load = timed(_fresh, utils.get_data)
+    store, store_load = timed(_fresh, utils.get_store)
+    rows = store.user_id
+
+    results = {}
+    for name, model, stats, load in (
+            ('dict', data, _dict_stats, dict_load),
+            ('columnar', store, _store_stats, store_load)):
+        started = time.time()
+        for user_id in model.keys():
+            stats(model, user_id)
+        memory = deep_sizeof(model)
+        results[name] = {
+            'load_s': load,
+            'memory_bytes': memory,
+            'bytes_per_row': float(memory) / max(len(rows), 1),
+            'all_users_stats_s': time.time() - started,
+        }
+    return results
+
+
+def _csv_reader_rows(lines):
+    """
+    Parses lines the way `get_data` used to: `csv.reader` and strptime.
+    """
+    for row in csv.reader(lines, delimiter=','):
+        if len(row) != 4:
+            continue
+        try:
+            yield utils.parse_presence_row(row)
+        except (ValueError, TypeError):
+            continue
+
+
+def compare_parsers(csv_path):
+    """
+    Returns rows per second of strptime based and fixed-format parsers.
+    """
+    with open(csv_path, 'rb') as csvfile:
+        lines = csvfile.readlines()
+
+    results = {}
+    for name, parser in (
+            ('csv_reader', _csv_reader_rows),
+            ('fixed_format', utils.parse_presence_lines)):
+        rows, seconds = timed(lambda: sum(1 for _ in parser(lines)))
+        results[name] = {
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_s': rows / seconds if seconds else float('inf'),
+        }
+    return results
+
+
+def generate_presence_csv(path, users, years, seed=0):
+    """
+    Writes synthetic presence CSV with `users` users over `years` years.
+
+    Users come on most working days, arriving around 8:30 and staying
+    around 8 hours. Returns number of written rows.
+    """
+    rand = random.Random(seed)
+    last_day = datetime.date(2013, 12, 31)
+    first_day = last_day - datetime.timedelta(days=365 * years)
+    rows = 0
+    with open(path, 'wb') as csvfile:
+        for user_id in range(1, users + 1):
+            day = first_day
+            while day <= last_day:
+                if day.weekday() < 5 and rand.random() < 0.9 or \
+                        rand.random() < 0.02:
+                    start = int(rand.gauss(8.5 * 3600, 2700))
+                    start = min(max(start, 5 * 3600), 14 * 3600)
+                    end = start + int(rand.gauss(8 * 3600, 3600))
+                    end = min(max(end, start + 600), 86399)
+                    csvfile.write('{0},{1},{2},{3}\n'.format(
+                        user_id, day.isoformat(),
+                        _format_seconds(start), _format_seconds(end),
+                    ))
+                    rows += 1
+                day += datetime.timedelta(days=1)
+    return rows
+
+
+def _format_seconds(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '{0:02d}:{1:02d}:{2:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60,
+    )
+
+
+def generate_users_xml(path, users):
+    """
+    Writes synthetic users XML in the intranet format.
+    """
+    with open(path, 'wb') as xml_file:
+        xml_file.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>\n'
+            '    <server>\n        <host>intranet.example.com</host>\n'
+            '        <port>443</port>\n        <protocol>https</protocol>\n'
+            '    </server>\n    <users>\n'
+        )
+        for user_id in range(1, users + 1):
+            xml_file.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>User {0}</name>\n'
+                '        </user>\n'.format(user_id)
+            )
+        xml_file.write('    </users>\n</intranet>\n')
+
+
+def benchmark_endpoints(requests):
+    """
+    Returns latency of every API endpoint called through Flask test client.
+
+    The first request of every endpoint is measured separately as it may
+    include building cached data. Response cache is disabled, so that
+    repeated requests measure the data model rather than cache hits.
+    """
+    cache_bytes = app.config.get('RESPONSE_CACHE_BYTES')
+    app.config['RESPONSE_CACHE_BYTES'] = 0
+    try:
+        return _benchmark_endpoints(requests)
+    finally:
+        if cache_bytes is None:
+            del app.config['RESPONSE_CACHE_BYTES']
+        else:
+            app.config['RESPONSE_CACHE_BYTES'] = cache_bytes
+
+
+def _benchmark_endpoints(requests):
+    """
+    Returns latency of every API endpoint with response cache disabled.
+    """
+    client = app.test_client()
+    user_ids = utils.get_presence_source().keys()
+    days = [
+        datetime.date.fromordinal(day).isoformat()
+        for day in utils.get_day_events()['day']
+    ]
+    rand = random.Random(0)
+    results = {}
+    for endpoint in ENDPOINTS:
+        latencies = []
+        for _ in range(requests + 1):
+            url = endpoint.format(
+                user_id=rand.choice(user_ids), day=rand.choice(days),
+            )
+            started = time.time()
+            resp = client.get(url)
+            latencies.append(time.time() - started)
+            if resp.status_code != 200:
+                raise RuntimeError('{0} returned {1}'.format(
+                    url, resp.status_code,
+                ))
+        warm = sorted(latencies[1:])
+        results[endpoint] = {
+            'first_ms': latencies[0] * 1000,
+            'mean_ms': sum(warm) / len(warm) * 1000,
+            'p95_ms': warm[int(0.95 * (len(warm) - 1))] * 1000,
+        }
+    return results
+
+
+def benchmark_loading(csv_path):
+    """
+    Returns cold load times from CSV and from snapshot of every data model.
+    """
+    models = [('dict', False)]
+    if numpy is not None:
+        models.append(('columnar', True))
+    results = {}
+    for name, columnar in models:
+        app.config.update({
+            'DATA_CSV': csv_path,
+            'COLUMNAR_STORE': columnar,
+            'DATA_SNAPSHOT': True,
+        })
+        snapshot_file = csv_path + '.snapshot'
+        if os.path.exists(snapshot_file):
+            os.remove(snapshot_file)
+        _, from_csv = timed(_fresh, utils.get_presence_source)
+        _, from_snapshot = timed(_fresh, utils.get_presence_source)
+        results[name] = {
+            'from_csv_s': from_csv,
+            'from_snapshot_s': from_snapshot,
+        }
+    return results
+
+
+def benchmark_parallel_parsing(csv_path):
+    """
+    Returns cold load time of CSV file parsed by 1, 2 and 4 worker
+    processes (and one per CPU) for every data model, with speedup over
+    one process and number of CPUs the numbers were taken on.
+    """
+    counts = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+    models = [('dict', False)]
+    if numpy is not None:
+        models.append(('columnar', True))
+
+    results = {'cpus': multiprocessing.cpu_count()}
+    for name, columnar in models:
+        model = results[name] = {}
+        for workers in counts:
+            app.config.update({
+                'DATA_CSV': csv_path,
+                'COLUMNAR_STORE': columnar,
+                'DATA_SNAPSHOT': False,
+                'DATA_WORKERS': workers,
+                'DATA_PARALLEL_MIN_BYTES': 0,
+            })
+            loader = utils.get_store if columnar else utils.get_data
+            _, seconds = timed(_fresh, loader)
+            model[workers] = {'load_s': seconds}
+        for result in model.itervalues():
+            result['speedup'] = model[1]['load_s'] / result['load_s']
+    del app.config['DATA_WORKERS'], app.config['DATA_PARALLEL_MIN_BYTES']
+    return results
+
+
+def run_suite(csv_path, requests):
+    """
+    Runs all benchmarks on given CSV file, returns results.
+    """
+    results = {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__ if numpy is not None else None,
+        'csv_bytes': os.path.getsize(csv_path),
+        'parsers': compare_parsers(csv_path),
+        'loading': benchmark_loading(csv_path),
+        'parallel_parsing': benchmark_parallel_parsing(csv_path),
+    }
+    if numpy is not None:
+        results['models'] = compare_models(csv_path)
+
+    results['endpoints'] = {}
+    for name, columnar in (('dict', False), ('columnar', True)):
+        if columnar and numpy is None:
+            continue
+        app.config.update({
+            'DATA_CSV': csv_path,
+            'COLUMNAR_STORE': columnar,
+            'DATA_SNAPSHOT': False,
+        })
+        forget_loaded_data()
+        results['endpoints'][name] = benchmark_endpoints(requests)
+
+    # ru_maxrss is in kilobytes on Linux
+    results['peak_rss_kb'] = resource.getrusage(
+        resource.RUSAGE_SELF,
+    ).ru_maxrss
+    return results
+
+
+def main(argv=None):
+    """
+    Runs benchmark suite and outputs results as JSON.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--csv', help='existing presence CSV file')
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--output', help='file to write JSON results to')
+    args = parser.parse_args(argv)
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        users_xml = os.path.join(temp_dir, 'users.xml')
+        generate_users_xml(users_xml, args.users)
+        app.config.update({'USERS_XML_LOCAL_FILE': users_xml})
+        if args.csv:
+            csv_path = os.path.join(temp_dir, 'data.csv')
+            shutil.copy(args.csv, csv_path)
+            scale = {'csv': args.csv}
+        else:
+            csv_path = os.path.join(temp_dir, 'data.csv')
+            scale = {
+                'users': args.users,
+                'years': args.years,
+                'rows': generate_presence_csv(
+                    csv_path, args.users, args.years,
+                ),
+            }
+        results = run_suite(csv_path, args.requests)
+        results['scale'] = scale
+    finally:
+        shutil.rmtree(temp_dir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight counters and histograms exposed in Prometheus text format.
+"""
+from bisect import bisect_left
+import threading
+import time
+
+from flask import g, request
+
+from presence_analyzer.main import app
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'presence_http_request_duration_seconds': (
+        'histogram', 'Request latency by route.',
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+    ),
+    'presence_cache_requests_total': (
+        'counter', 'Cached function calls by result (hit, stale, miss, '
+        'reload).', None,
+    ),
+    'presence_csv_parse_seconds': (
+        'histogram', 'Time of parsing presence CSV file (or its tail).',
+        (0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+    ),
+    'presence_csv_rows_total': (
+        'counter', 'Parsed presence CSV rows.', None,
+    ),
+    'presence_csv_bad_lines_total': (
+        'counter', 'Skipped malformed presence CSV lines.', None,
+    ),
+}
+
+LOCK = threading.Lock()
+COUNTERS = {}
+HISTOGRAMS = {}
+COLLECTORS = []
+
+
+def increment(name, labels=(), amount=1):
+    """
+    Increments counter with given labels, a tuple of (name, value) pairs.
+    """
+    key = (name, labels)
+    with LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + amount
+
+
+def observe(name, value, labels=()):
+    """
+    Records value in histogram with given labels.
+    """
+    buckets = METRICS[name][2]
+    key = (name, labels)
+    with LOCK:
+        histogram = HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = HISTOGRAMS[key] = {
+                'buckets': [0] * (len(buckets) + 1),
+                'sum': 0.0,
+                'count': 0,
+            }
+        histogram['buckets'][bisect_left(buckets, value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def counter_values():
+    """
+    Returns copy of all counter values.
+    """
+    with LOCK:
+        return dict(COUNTERS)
+
+
+def counters_since(previous):
+    """
+    Returns counter increments since `counter_values` returned previous.
+    """
+    with LOCK:
+        return dict(
+            (key, value - previous.get(key, 0))
+            for key, value in COUNTERS.iteritems()
+            if value != previous.get(key, 0)
+        )
+
+
+def add_counters(increments):
+    """
+    Adds counter increments, e.g. the ones made by worker process.
+    """
+    with LOCK:
+        for key, amount in increments.iteritems():
+            COUNTERS[key] = COUNTERS.get(key, 0) + amount
+
+
+def add_collector(collector):
+    """
+    Registers function returning extra (name, type, help, labels, value)
+    samples, called whenever metrics are rendered.
+    """
+    COLLECTORS.append(collector)
+
+
+def reset():
+    """
+    Forgets all recorded values.
+    """
+    with LOCK:
+        COUNTERS.clear()
+        HISTOGRAMS.clear()
+
+
+def _format_labels(labels):
+    """
+    Formats labels as {name="value",...}.
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(
+            name,
+            unicode(value).replace('\\', '\\\\').replace('"', '\\"'),
+        )
+        for name, value in labels
+    ) + '}'
+
+
+def _format_value(value):
+    """
+    Formats sample value.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Returns all metrics in Prometheus text exposition format.
+    """
+    with LOCK:
+        counters = sorted(COUNTERS.items())
+        histograms = sorted(
+            (key, dict(value, buckets=list(value['buckets'])))
+            for key, value in HISTOGRAMS.iteritems()
+        )
+
+    samples = {}
+    for (name, labels), value in counters:
+        samples.setdefault(name, []).append((name, labels, value))
+    for (name, labels), histogram in histograms:
+        cumulative = 0
+        bounds = METRICS[name][2] + (float('inf'),)
+        for bound, count in zip(bounds, histogram['buckets']):
+            cumulative += count
+            samples.setdefault(name, []).append((
+                name + '_bucket',
+                labels + (('le', _format_value(float(bound))),),
+                cumulative,
+            ))
+        samples[name].append((name + '_sum', labels, histogram['sum']))
+        samples[name].append((name + '_count', labels, histogram['count']))
+
+    types = dict(
+        (name, (metric_type, help_text))
+        for name, (metric_type, help_text, _) in METRICS.iteritems()
+    )
+    for collector in COLLECTORS:
+        for name, metric_type, help_text, labels, value in collector():
+            types[name] = (metric_type, help_text)
+            samples.setdefault(name, []).append((name, labels, value))
+
+    lines = []
+    for name in sorted(samples):
+        metric_type, help_text = types[name]
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, metric_type))
+        for sample_name, labels, value in samples[name]:
+            lines.append('{0}{1} {2}'.format(
+                sample_name, _format_labels(labels), _format_value(value),
+            ))
+    return '\n'.join(lines) + '\n'
+
+
+@app.before_request
+def _start_timer():
+    """
+    Remembers when request processing started.
+    """
+    g.request_started = time.time()
+
+
+@app.teardown_request
+def _observe_latency(_exception=None):
+    """
+    Records request latency of matched route.
+    """
+    started = getattr(g, 'request_started', None)
+    if started is None or request.url_rule is None:
+        return
+    observe(
+        'presence_http_request_duration_seconds',
+        time.time() - started,
+        (('route', request.url_rule.rule),),
+    )
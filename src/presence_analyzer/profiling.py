@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand profiling of selected requests with cProfile.
+"""
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from werkzeug.urls import url_decode
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class ProfilingMiddleware(object):
+    """
+    WSGI middleware running selected requests under cProfile.
+
+    Request is profiled when it has `X-Profile` header or `profile` query
+    argument, or randomly with probability `sample_rate`. Profile of every
+    such request is written to `directory` as .prof file together with
+    a .txt summary of `top` functions with the highest cumulative time.
+    """
+
+    def __init__(self, wsgi_app, directory, sample_rate=0.0, top=30):
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.top = top
+
+    def __call__(self, environ, start_response):
+        if not self.selected(environ):
+            return self.wsgi_app(environ, start_response)
+
+        profiler = cProfile.Profile()
+        started = time.time()
+        response = profiler.runcall(self.consume, environ, start_response)
+        self.write(profiler, environ, started)
+        return response
+
+    def consume(self, environ, start_response):
+        """
+        Calls application and reads the whole body, which may be lazy.
+        """
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            return list(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    def selected(self, environ):
+        """
+        Tells whether request should be profiled.
+        """
+        if 'HTTP_X_PROFILE' in environ or \
+                'profile' in url_decode(environ.get('QUERY_STRING', '')):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def write(self, profiler, environ, started):
+        """
+        Writes profile and its summary, returns path of the profile.
+
+        Name is made unique by microseconds of the start time, process id
+        and thread id, so concurrent requests to one URL do not collide.
+        """
+        name = '{0}.{1:06d}-{2}-{3}-{4}-{5}'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(started)),
+            int(started % 1 * 1000000),
+            os.getpid(),
+            threading.current_thread().ident,
+            environ.get('REQUEST_METHOD', 'GET'),
+            re.sub(r'[^\w.-]+', '_', environ.get('PATH_INFO', '')).strip('_'),
+        )
+        path = os.path.join(self.directory, name)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            profiler.dump_stats(path + '.prof')
+            with open(path + '.txt', 'w') as summary:
+                summary.write('{0} {1}?{2} took {3:.3f}s\n\n'.format(
+                    environ.get('REQUEST_METHOD', 'GET'),
+                    environ.get('PATH_INFO', ''),
+                    environ.get('QUERY_STRING', ''),
+                    time.time() - started,
+                ))
+                stats = pstats.Stats(profiler, stream=summary)
+                stats.sort_stats('cumulative').print_stats(self.top)
+        except (IOError, OSError):
+            log.warning('Cannot write profile %s', path, exc_info=True)
+            return None
+        log.info('Request profile written to %s.prof', path)
+        return path + '.prof'
+
+
+def enable_profiling(app, directory):
+    """
+    Wraps application with `ProfilingMiddleware` configured by PROFILING_*
+    config keys. Does nothing when PROFILING is not enabled.
+    """
+    if not app.config.get('PROFILING', False) or \
+            isinstance(app.wsgi_app, ProfilingMiddleware):
+        return
+    app.wsgi_app = ProfilingMiddleware(
+        app.wsgi_app,
+        app.config.get('PROFILING_DIR', directory),
+        sample_rate=app.config.get('PROFILING_SAMPLE_RATE', 0.0),
+        top=app.config.get('PROFILING_TOP', 30),
+    )
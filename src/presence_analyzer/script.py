@@ -28,8 +28,10 @@ del _buildout_path
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
     from presence_analyzer import app
+    from presence_analyzer.profiling import enable_profiling
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    enable_profiling(app, abspath('var', 'profiles'))
     return app
 
 
@@ -40,6 +42,15 @@ def make_debug(global_conf={}, **conf):
     return DebuggedApplication(app, evalex=True)
 
 
+# bin/presence-dataset [parts/etc/deploy.cfg]
+def publish_dataset():
+    """Write shared presence dataset for worker processes."""
+    config = sys.argv[1] if len(sys.argv) > 1 else DEPLOY_CFG
+    make_app(config=config)
+    from presence_analyzer.utils import publish_shared_dataset
+    publish_shared_dataset()
+
+
 # bin/flask-ctl shell
 def make_shell():
     """Interactive Flask Shell"""
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of parsed presence data.
+
+Snapshot is kept next to the CSV file and holds four int32 columns (user
+id, day ordinal, start and end in seconds since midnight) sorted by user
+and day, together with the state of the CSV tail reader at the time it
+was written. Columns are stored in native byte order, so they can be
+memory-mapped directly.
+"""
+from array import array
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+MAGIC = 'PASNAP01'
+HEADER_SIZE = struct.Struct('<I')
+COLUMNS = 4
+
+
+def snapshot_path(csv_path):
+    """
+    Returns path of snapshot of given CSV file.
+    """
+    return csv_path + '.snapshot'
+
+
+def file_digest(path, length):
+    """
+    Returns SHA-1 hex digest of the first `length` bytes of file.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as data_file:
+        while length > 0:
+            chunk = data_file.read(min(length, 1 << 20))
+            if not chunk:
+                break
+            digest.update(chunk)
+            length -= len(chunk)
+    return digest.hexdigest()
+
+
+def write_snapshot(csv_path, columns, state, path=None):
+    """
+    Atomically writes snapshot of columns parsed from CSV file.
+
+    `state` is the tail reader state describing which part of the file
+    the columns come from. Snapshot is written next to the CSV file unless
+    other `path` is given. Readers which have the previous version open
+    (or memory-mapped) keep using it until they open the file again.
+    """
+    rows = len(columns[0])
+    header = json.dumps({
+        'rows': rows,
+        'sha1': file_digest(csv_path, state['offset']),
+        'state': dict(state, last_line=state['last_line'].decode('latin-1')),
+    })
+    # keep columns aligned to their item size
+    header += ' ' * (-(len(MAGIC) + HEADER_SIZE.size + len(header)) % 4)
+
+    path = path or snapshot_path(csv_path)
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp',
+    )
+    try:
+        with os.fdopen(handle, 'wb') as snapshot_file:
+            snapshot_file.write(MAGIC)
+            snapshot_file.write(HEADER_SIZE.pack(len(header)))
+            snapshot_file.write(header)
+            for column in columns:
+                if numpy is not None:
+                    numpy.asarray(column, dtype=numpy.int32).tofile(
+                        snapshot_file,
+                    )
+                else:
+                    array('i', column).tofile(snapshot_file)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        log.warning('Cannot write snapshot %s', path, exc_info=True)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _read_header(snapshot_file):
+    """
+    Returns snapshot header and offset of the first column.
+
+    Raises ValueError for files which are not snapshots.
+    """
+    if snapshot_file.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a presence snapshot')
+    size_bytes = snapshot_file.read(HEADER_SIZE.size)
+    if len(size_bytes) != HEADER_SIZE.size:
+        raise ValueError('Truncated presence snapshot')
+    header_size = HEADER_SIZE.unpack(size_bytes)[0]
+    header = json.loads(snapshot_file.read(header_size))
+    return header, len(MAGIC) + HEADER_SIZE.size + header_size
+
+
+def _matching_state(csv_path, header):
+    """
+    Returns tail reader state of snapshot if it matches current CSV file.
+    """
+    state = header['state']
+    state['identity'] = tuple(state['identity'])
+    state['last_line'] = state['last_line'].encode('latin-1')
+    stat = os.stat(csv_path)
+    if stat.st_size < state['offset']:
+        return None
+    identity = (stat.st_dev, stat.st_ino)
+    if (identity, stat.st_size, stat.st_mtime) != \
+            (state['identity'], state['size'], state['mtime']):
+        # file was touched, replaced or appended to, compare the content
+        if file_digest(csv_path, state['offset']) != header['sha1']:
+            return None
+        state['identity'] = identity
+    return state
+
+
+def _read_columns(snapshot_file, path, rows, offset, memory_map):
+    """
+    Returns snapshot columns which start at given offset.
+    """
+    if not memory_map:
+        columns = []
+        for _ in range(COLUMNS):
+            column = array('i')
+            column.fromfile(snapshot_file, rows)
+            columns.append(column)
+        return tuple(columns)
+    if rows:
+        matrix = numpy.memmap(
+            path, dtype=numpy.int32, mode='r',
+            offset=offset, shape=(COLUMNS, rows),
+        )
+    else:
+        matrix = numpy.zeros((COLUMNS, 0), dtype=numpy.int32)
+    return tuple(matrix)
+
+
+def read_snapshot(csv_path, memory_map=False):
+    """
+    Returns (columns, state) of snapshot matching CSV file, None otherwise.
+
+    Columns are NumPy memory maps when `memory_map` is set, arrays
+    otherwise.
+    """
+    path = snapshot_path(csv_path)
+    try:
+        with open(path, 'rb') as snapshot_file:
+            header, offset = _read_header(snapshot_file)
+            state = _matching_state(csv_path, header)
+            if state is None:
+                log.debug('Snapshot %s is outdated', path)
+                return None
+            columns = _read_columns(
+                snapshot_file, path, header['rows'], offset, memory_map,
+            )
+    except (IOError, OSError, EOFError, ValueError, KeyError):
+        log.debug('Cannot read snapshot %s', path, exc_info=True)
+        return None
+    return columns, state
+
+
+def read_dataset(path, memory_map=False):
+    """
+    Returns (columns, header) of snapshot file, regardless of whether its
+    CSV file has changed since. Returns None for missing or broken files.
+    """
+    try:
+        with open(path, 'rb') as snapshot_file:
+            header, offset = _read_header(snapshot_file)
+            columns = _read_columns(
+                snapshot_file, path, header['rows'], offset, memory_map,
+            )
+    except (IOError, OSError, EOFError, ValueError, KeyError):
+        log.debug('Cannot read dataset %s', path, exc_info=True)
+        return None
+    return columns, header
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar presence store backed by NumPy arrays.
+"""
+import calendar
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+
+class PresenceStore(object):
+    """
+    Presence rows kept as parallel arrays sorted by user and day.
+
+    Every row is described by four values: user id, day ordinal (as
+    returned by `datetime.date.toordinal`), start and end of presence in
+    seconds since midnight. Rows of a single user occupy a contiguous
+    slice which boundaries are kept in `offsets`.
+    """
+
+    def __init__(self, user_ids, days, starts, ends):
+        """
+        Sorts given columns, drops duplicated user-days (the last one
+        wins, as in `get_data`) and builds per-user offset index.
+        """
+        user_ids = numpy.asarray(user_ids, dtype=numpy.int32)
+        days = numpy.asarray(days, dtype=numpy.int32)
+        starts = numpy.asarray(starts, dtype=numpy.int32)
+        ends = numpy.asarray(ends, dtype=numpy.int32)
+
+        order = numpy.lexsort((days, user_ids))
+        user_ids = user_ids[order]
+        days = days[order]
+        keep = numpy.ones(len(order), dtype=bool)
+        keep[:-1] = (user_ids[1:] != user_ids[:-1]) | (days[1:] != days[:-1])
+        order = order[keep]
+        self._set_columns(
+            user_ids[keep], days[keep], starts[order], ends[order],
+        )
+
+    @classmethod
+    def from_sorted(cls, user_ids, days, starts, ends):
+        """
+        Creates store from columns already sorted by user and day, without
+        duplicated user-days. Columns (e.g. memory-mapped) are not copied.
+        """
+        presence_store = cls.__new__(cls)
+        presence_store._set_columns(  # pylint: disable=protected-access
+            user_ids, days, starts, ends,
+        )
+        return presence_store
+
+    def _set_columns(self, user_ids, days, starts, ends):
+        """
+        Sets sorted columns and builds derived columns and per-user index.
+        """
+        self.user_id = user_ids
+        self.day = days
+        self.start = starts
+        self.end = ends
+        self.interval = self.end - self.start
+        # date(1, 1, 1) has ordinal 1 and is a Monday
+        self.weekday = ((self.day - 1) % 7).astype(numpy.uint8)
+
+        self.users, first = numpy.unique(self.user_id, return_index=True)
+        self.offsets = numpy.append(first, len(self.user_id))
+        self._index = dict(
+            (user_id, idx) for idx, user_id in enumerate(self.users.tolist())
+        )
+
+    def __contains__(self, user_id):
+        return user_id in self._index
+
+    def __len__(self):
+        return len(self.user_id)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the arrays.
+        """
+        return sum(
+            column.nbytes
+            for column in (
+                self.user_id, self.day, self.start, self.end,
+                self.interval, self.weekday, self.users, self.offsets,
+            )
+        )
+
+    def extend(self, rows):
+        """
+        Returns new store with given rows merged in.
+
+        Rows are (user_id, day ordinal, start seconds, end seconds) tuples
+        and override already stored rows of the same user-day.
+        """
+        rows = list(rows)
+        if not rows:
+            return self
+        user_ids, days, starts, ends = zip(*rows)
+        return PresenceStore(
+            numpy.concatenate((self.user_id, user_ids)),
+            numpy.concatenate((self.day, days)),
+            numpy.concatenate((self.start, starts)),
+            numpy.concatenate((self.end, ends)),
+        )
+
+    def keys(self):
+        """
+        Returns sorted list of known user ids.
+        """
+        return self.users.tolist()
+
+    def user_slice(self, user_id):
+        """
+        Returns slice of rows which belong to given user.
+        """
+        idx = self._index[user_id]
+        return slice(self.offsets[idx], self.offsets[idx + 1])
+
+    def group_by_weekday(self, user_id):
+        """
+        Returns list of interval arrays, one for every day in week.
+        """
+        rows = self.user_slice(user_id)
+        weekdays = self.weekday[rows]
+        intervals = self.interval[rows]
+        return [intervals[weekdays == day] for day in range(7)]
+
+    def _bincount(self, user_id, values):
+        """
+        Returns per weekday row counts and sums of given column values.
+        """
+        rows = self.user_slice(user_id)
+        weekdays = self.weekday[rows]
+        counts = numpy.bincount(weekdays, minlength=7)
+        sums = numpy.bincount(weekdays, weights=values[rows], minlength=7)
+        return counts, sums
+
+    def _mean(self, user_id, values):
+        """
+        Returns per weekday arithmetic mean of given column values.
+        """
+        counts, sums = self._bincount(user_id, values)
+        means = numpy.zeros(7)
+        present = counts > 0
+        means[present] = sums[present] / counts[present]
+        return means.tolist()
+
+    def weekday_sums(self, user_id):
+        """
+        Returns total presence time of given user grouped by weekday.
+        """
+        _, sums = self._bincount(user_id, self.interval)
+        return [int(total) for total in sums]
+
+    def weekday_means(self, user_id):
+        """
+        Returns mean presence time of given user grouped by weekday.
+        """
+        return self._mean(user_id, self.interval)
+
+    def weekday_start_end_means(self, user_id):
+        """
+        Returns mean start and mean end of given user grouped by weekday.
+        """
+        return zip(
+            self._mean(user_id, self.start),
+            self._mean(user_id, self.end),
+        )
+
+    def weekday_medians(self, user_id):
+        """
+        Returns median presence time of given user grouped by weekday.
+        """
+        return [
+            float(numpy.median(intervals)) if len(intervals) else 0.0
+            for intervals in self.group_by_weekday(user_id)
+        ]
+
+    def weekday_table(self):
+        """
+        Returns per user, per weekday statistics of all users at once.
+
+        See `utils.get_weekday_stats` for the structure.
+        """
+        size = len(self.users) * 7
+        user_idx = numpy.repeat(
+            numpy.arange(len(self.users)), numpy.diff(self.offsets),
+        )
+        group = user_idx * 7 + self.weekday
+        counts = numpy.bincount(group, minlength=size)
+        present = counts > 0
+
+        def group_mean(values):
+            """
+            Returns mean of values in every user-weekday group.
+            """
+            sums = numpy.bincount(group, weights=values, minlength=size)
+            means = numpy.zeros(size)
+            means[present] = sums[present] / counts[present]
+            return means
+
+        sums = numpy.bincount(group, weights=self.interval, minlength=size)
+        sorted_intervals = numpy.split(
+            self.interval[numpy.lexsort((self.interval, group))],
+            numpy.cumsum(counts)[:-1],
+        )
+
+        columns = {
+            'count': counts,
+            'sum': sums.astype(numpy.int64),
+            'mean': group_mean(self.interval),
+            'start': group_mean(self.start),
+            'end': group_mean(self.end),
+        }
+        columns = dict(
+            (name, column.reshape(-1, 7).tolist())
+            for name, column in columns.iteritems()
+        )
+        columns['intervals'] = [
+            sorted_intervals[idx:idx + 7] for idx in range(0, size, 7)
+        ]
+        return dict(
+            (
+                user_id,
+                dict((name, columns[name][idx]) for name in columns),
+            )
+            for idx, user_id in enumerate(self.users.tolist())
+        )
+
+    def date_index(self):
+        """
+        Returns rows ordered by user, weekday and day with prefix sums.
+
+        See `utils.get_date_index` for the structure.
+        """
+        size = len(self.users) * 7
+        user_idx = numpy.repeat(
+            numpy.arange(len(self.users)), numpy.diff(self.offsets),
+        )
+        group = user_idx * 7 + self.weekday
+        # rows are sorted by day within every user already
+        order = numpy.lexsort((self.day, group))
+        bounds = numpy.append(
+            0, numpy.cumsum(numpy.bincount(group, minlength=size)),
+        ).tolist()
+
+        def prefix_sums(values):
+            """
+            Returns running totals of column values, starting with zero.
+            """
+            return numpy.append(
+                0, numpy.cumsum(values[order], dtype=numpy.int64),
+            )
+
+        return {
+            'groups': dict(
+                (
+                    user_id,
+                    [
+                        (bounds[idx * 7 + day], bounds[idx * 7 + day + 1])
+                        for day in range(7)
+                    ],
+                )
+                for idx, user_id in enumerate(self.users.tolist())
+            ),
+            'day': self.day[order],
+            'interval': self.interval[order],
+            'interval_sums': prefix_sums(self.interval),
+            'start_sums': prefix_sums(self.start),
+            'end_sums': prefix_sums(self.end),
+        }
+
+    def occupancy(self, user_id=None, slot=3600):
+        """
+        Returns presence seconds of user (all users for None) within every
+        `slot` seconds long part of every day in week.
+
+        See `utils.occupancy_table` for the structure.
+        """
+        rows = self.user_slice(user_id) if user_id is not None \
+            else slice(None)
+        return occupancy_table(
+            self.weekday[rows], self.start[rows], self.end[rows], slot,
+        )
+
+    def day_events(self):
+        """
+        Returns sorted start and end times of rows of every day.
+
+        See `utils.get_day_events` for the structure.
+        """
+        rows = numpy.flatnonzero(self.end > self.start)
+        days = self.day[rows]
+        by_start = rows[numpy.lexsort((self.start[rows], days))]
+        by_end = rows[numpy.lexsort((self.end[rows], days))]
+        day_list, firsts = numpy.unique(self.day[by_start], return_index=True)
+        bounds = numpy.append(firsts, len(rows)).tolist()
+        starts = self.start[by_start].tolist()
+        ends = self.end[by_end].tolist()
+        return {
+            'day': day_list.tolist(),
+            'starts': [
+                starts[first:last] for first, last in zip(bounds, bounds[1:])
+            ],
+            'ends': [
+                ends[first:last] for first, last in zip(bounds, bounds[1:])
+            ],
+        }
+
+    def weekday_summary(self, user_ids=None):
+        """
+        Returns weekday statistics of all rows of given users.
+
+        See `utils.get_group_weekday_summary` for the structure.
+        """
+        rows = numpy.arange(len(self))
+        if user_ids is not None:
+            rows = numpy.concatenate([numpy.array([], dtype=int)] + [
+                numpy.arange(self.offsets[idx], self.offsets[idx + 1])
+                for idx in sorted(
+                    self._index[user_id]
+                    for user_id in user_ids
+                    if user_id in self._index
+                )
+            ])
+        weekdays = self.weekday[rows]
+        counts = numpy.bincount(weekdays, minlength=7)
+        firsts = numpy.cumsum(counts) - counts
+        columns = {}
+        for name in ('interval', 'start', 'end'):
+            values = getattr(self, name)[rows]
+            columns[name] = values[numpy.lexsort((values, weekdays))]
+
+        def distribution(day, name):
+            """
+            Returns mean and quartiles of column values of given weekday.
+            """
+            values = columns[name][firsts[day]:firsts[day] + counts[day]]
+            if not len(values):
+                return {'mean': 0, 'p25': 0.0, 'median': 0.0, 'p75': 0.0}
+            p25, p50, p75 = numpy.percentile(values, [25, 50, 75]).tolist()
+            return {
+                'mean': float(values.mean()),
+                'p25': p25,
+                'median': p50,
+                'p75': p75,
+            }
+
+        summary = []
+        for day in range(7):
+            intervals = distribution(day, 'interval')
+            summary.append({
+                'weekday': calendar.day_abbr[day],
+                'count': int(counts[day]),
+                'total': int(columns['interval'][
+                    firsts[day]:firsts[day] + counts[day]
+                ].sum()),
+                'mean': intervals['mean'],
+                'median': intervals['median'],
+                'start': distribution(day, 'start'),
+                'end': distribution(day, 'end'),
+            })
+        return summary
+
+
+def occupancy_table(weekdays, starts, ends, slot):
+    """
+    Returns 7 lists of presence seconds within consecutive `slot` seconds
+    long parts of day, accumulated from start and end columns.
+
+    Partial first and last slots of every entry are added directly, whole
+    slots in between through a difference array summed up once per row.
+    """
+    slots = 86400 // slot
+    size = 7 * (slots + 1)
+    starts = starts.astype(numpy.int64)
+    ends = numpy.maximum(ends.astype(numpy.int64), starts)
+    first = starts // slot
+    last = ends // slot
+    same = first == last
+    # padding slot of every weekday takes differences ending at midnight
+    rows = weekdays.astype(numpy.int64) * (slots + 1)
+
+    def accumulate(positions, values):
+        """
+        Returns per slot sums of values.
+        """
+        return numpy.bincount(positions, weights=values, minlength=size)
+
+    whole = numpy.where(same, 0, slot)
+    cells = accumulate(
+        rows + first,
+        numpy.where(same, ends - starts, (first + 1) * slot - starts),
+    )
+    cells += accumulate(rows + last, numpy.where(same, 0, ends - last * slot))
+    differences = accumulate(rows + first + 1, whole) - \
+        accumulate(rows + last, whole)
+    cells += numpy.cumsum(differences.reshape(7, slots + 1), axis=1).ravel()
+    return cells.reshape(7, slots + 1)[:, :slots].astype(numpy.int64).tolist()
+
+
+def build_store(rows):
+    """
+    Builds `PresenceStore` from iterable of
+    (user_id, day ordinal, start seconds, end seconds) tuples.
+    """
+    return PresenceStore([], [], [], []).extend(rows)
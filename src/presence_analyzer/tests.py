@@ -5,13 +5,29 @@ Presence analyzer unit tests.
 """
 import os.path
 import json
+import shutil
+import tempfile
+import threading
+import time
 import datetime
 import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from gzip import GzipFile
+from StringIO import StringIO
 
 from presence_analyzer import (
+    backends,
+    benchmark,
     main,
+    metrics,
+    profiling,
+    snapshot,
+    store,
+    user_index,
+    users_cron,
     utils
 )
+from presence_analyzer.store import numpy
 
 
 TEST_DATA_CSV = os.path.join(
@@ -23,6 +39,11 @@ TEST_USER_XML = os.path.join(
 )
 
 
+requires_numpy = unittest.skipIf(  # pylint: disable=invalid-name
+    numpy is None, 'NumPy (presence_analyzer[columnar]) is not installed',
+)
+
+
 # pylint: disable=maybe-no-member, too-many-public-methods
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
     """
@@ -163,6 +184,550 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
 
         self.assertEqual(resp_data, expected_data)
 
+    def test_percentiles_weekday_view(self):
+        """
+        Test percentiles and histogram of presence time.
+        """
+        resp = self.client.get('/api/v1/percentiles_weekday/10000')
+        self.assertEqual(json.loads(resp.data), 'no_data')
+
+        resp = self.client.get('/api/v1/percentiles_weekday/11')
+        self.assertEqual(resp.status_code, 200)
+        resp_data = json.loads(resp.data)
+        self.assertEqual(len(resp_data), 7)
+        self.assertEqual(
+            resp_data[3],
+            {
+                'weekday': 'Thu',
+                'count': 2,
+                'percentiles': {
+                    '10': 22972.0,
+                    '25': 22976.5,
+                    '50': 22984.0,
+                    '75': 22991.5,
+                    '90': 22996.0,
+                },
+            },
+        )
+
+        resp = self.client.get(
+            '/api/v1/percentiles_weekday/11?percentiles=50,99.5&bin_width=30'
+        )
+        resp_data = json.loads(resp.data)
+        self.assertEqual(
+            resp_data[3]['percentiles'],
+            {'50': 22984.0, '99.5': 22998.85},
+        )
+        self.assertEqual(resp_data[3]['histogram'], [[22950, 1], [22980, 1]])
+        self.assertEqual(resp_data[6]['histogram'], [])
+
+        for query in ('percentiles=101', 'percentiles=a', 'bin_width=0'):
+            resp = self.client.get(
+                '/api/v1/percentiles_weekday/11?{0}'.format(query)
+            )
+            self.assertEqual(resp.status_code, 400)
+
+    def test_median_weekday_view(self):
+        """
+        Test median presence time view.
+        """
+        resp = self.client.get('/api/v1/median_weekday/10000')
+        self.assertEqual(json.loads(resp.data), 'no_data')
+
+        resp = self.client.get('/api/v1/median_weekday/11')
+        self.assertEqual(
+            json.loads(resp.data),
+            [
+                ['Mon', 24123.0],
+                ['Tue', 16564.0],
+                ['Wed', 25321.0],
+                ['Thu', 22984.0],
+                ['Fri', 6426.0],
+                ['Sat', 0.0],
+                ['Sun', 0.0],
+            ],
+        )
+
+    def test_bulk_view(self):
+        """
+        Test statistics of many users at once.
+        """
+        resp = self.client.get('/api/v1/bulk/mean_time_weekday?user_ids=all')
+        self.assertEqual(resp.status_code, 200)
+        resp_data = json.loads(resp.data)
+        self.assertItemsEqual(resp_data.keys(), ['10', '11'])
+        self.assertEqual(
+            resp_data['10'],
+            json.loads(self.client.get('/api/v1/mean_time_weekday/10').data),
+        )
+
+        resp = self.client.get('/api/v1/bulk/presence_start_end?user_ids=11,7')
+        resp_data = json.loads(resp.data)
+        self.assertEqual(resp_data['7'], 'no_data')
+        self.assertEqual(
+            resp_data['11'],
+            json.loads(self.client.get('/api/v1/presence_start_end/11').data),
+        )
+
+        resp = self.client.get('/api/v1/bulk/median_weekday')
+        self.assertItemsEqual(json.loads(resp.data).keys(), ['10', '11'])
+
+        resp = self.client.get('/api/v1/bulk/median_weekday?user_ids=a')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/bulk/unknown')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_date_range(self):
+        """
+        Test statistics limited to a date range.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-10&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data),
+            [
+                ['Weekday', 'Presence (s)'],
+                ['Mon', 0],
+                ['Tue', 16564],
+                ['Wed', 25321],
+                ['Thu', 22969],
+                ['Fri', 0],
+                ['Sat', 0],
+                ['Sun', 0],
+            ],
+        )
+
+        for url in (
+                '/api/v1/presence_start_end/11',
+                '/api/v1/median_weekday/11',
+                '/api/v1/percentiles_weekday/10?bin_width=600'):
+            self.assertEqual(
+                json.loads(self.client.get(url + (
+                    '&' if '?' in url else '?'
+                ) + 'from=2013-01-01').data),
+                json.loads(self.client.get(url).data),
+            )
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10?to=2013-09-10')
+        self.assertEqual(
+            json.loads(resp.data)[:3],
+            [['Mon', 0], ['Tue', 30047.0], ['Wed', 0]],
+        )
+        resp = self.client.get(
+            '/api/v1/bulk/median_weekday?from=2014-01-01'
+        )
+        self.assertEqual(
+            json.loads(resp.data)['10'],
+            [
+                [day, 0.0]
+                for day in ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+            ],
+        )
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/bulk/median_weekday?to=yesterday')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_group_weekday_view(self):
+        """
+        Test weekday statistics of whole organisation and group of users.
+        """
+        resp = self.client.get('/api/v1/group_weekday')
+        self.assertEqual(resp.status_code, 200)
+        resp_data = json.loads(resp.data)
+        self.assertEqual(len(resp_data), 7)
+        self.assertEqual(resp_data[1]['weekday'], 'Tue')
+        self.assertEqual(resp_data[1]['count'], 2)
+        self.assertEqual(resp_data[1]['total'], 30047 + 16564)
+
+        resp = self.client.get('/api/v1/group_weekday?user_ids=10')
+        resp_data = json.loads(resp.data)
+        self.assertEqual(resp_data[1]['count'], 1)
+        self.assertEqual(resp_data[1]['median'], 30047.0)
+        self.assertEqual(
+            resp_data[1]['start'],
+            {'mean': 34745.0, 'p25': 34745.0, 'median': 34745.0,
+             'p75': 34745.0},
+        )
+        self.assertEqual(resp_data[0]['count'], 0)
+
+        resp = self.client.get('/api/v1/group_weekday?user_ids=x')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_heatmap_view(self):
+        """
+        Test weekday occupancy of user and of whole organisation.
+        """
+        resp = self.client.get('/api/v1/heatmap/10')
+        self.assertEqual(resp.status_code, 200)
+        resp_data = json.loads(resp.data)
+        self.assertEqual(len(resp_data), 7)
+        self.assertEqual(resp_data[1][0], 'Tue')
+        self.assertEqual(
+            resp_data[1][1][8:19],
+            [0, 1255] + [3600] * 7 + [3592, 0],
+        )
+        self.assertEqual(sum(resp_data[1][1]), 30047)
+        self.assertEqual(resp_data[0][1], [0] * 24)
+
+        resp = self.client.get('/api/v1/heatmap/10?resolution=quarter')
+        resp_data = json.loads(resp.data)
+        self.assertEqual(len(resp_data[1][1]), 96)
+        self.assertEqual(resp_data[1][1][37:40], [0, 355, 900])
+        self.assertEqual(sum(resp_data[1][1]), 30047)
+
+        resp = self.client.get('/api/v1/heatmap')
+        resp_data = json.loads(resp.data)
+        self.assertEqual(resp_data[1][1][9], 1255 + 2410)
+        self.assertEqual(resp_data[1][1][13], 3600 + 3354)
+        self.assertEqual(sum(resp_data[1][1]), 30047 + 16564)
+
+        resp = self.client.get('/api/v1/heatmap/10000')
+        self.assertEqual(json.loads(resp.data), 'no_data')
+        resp = self.client.get('/api/v1/heatmap?resolution=minute')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_occupancy_view(self):
+        """
+        Test office headcount timeline of a day and daily peaks.
+        """
+        resp = self.client.get('/api/v1/occupancy/2013-09-10')
+        self.assertEqual(resp.status_code, 200)
+        resp_data = json.loads(resp.data)
+        self.assertEqual(len(resp_data['timeline']), 1440)
+        self.assertEqual(resp_data['timeline'][559:561], [0, 1])
+        self.assertEqual(resp_data['timeline'][579:581], [1, 2])
+        self.assertEqual(resp_data['timeline'][835:837], [2, 1])
+        self.assertEqual(resp_data['timeline'][-1], 0)
+        self.assertEqual(resp_data['peak'], 2)
+        self.assertEqual(resp_data['peak_time'], 34745)
+
+        resp = self.client.get('/api/v1/occupancy/2013-09-08')
+        resp_data = json.loads(resp.data)
+        self.assertEqual(resp_data['timeline'], [0] * 1440)
+        self.assertEqual(resp_data['peak'], 0)
+        self.assertIsNone(resp_data['peak_time'])
+
+        resp = self.client.get(
+            '/api/v1/occupancy?from=2013-09-05&to=2013-09-11',
+        )
+        resp_data = json.loads(resp.data)
+        self.assertEqual(
+            [(day['date'], day['peak']) for day in resp_data],
+            [('2013-09-05', 1), ('2013-09-09', 1), ('2013-09-10', 2),
+             ('2013-09-11', 2)],
+        )
+        self.assertEqual(resp_data[3]['peak_time'], 33592)
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertEqual(len(json.loads(resp.data)), 6)
+
+        resp = self.client.get('/api/v1/occupancy/2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_conditional_get(self):
+        """
+        Test ETag and Last-Modified based conditional requests.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/10',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/11',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v1/group_weekday?user_ids=10',
+            headers={'If-Modified-Since': last_modified},
+        )
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(
+            '/api/v1/group_weekday?user_ids=10',
+            headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'},
+        )
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get('/api/v1/users_data')
+        resp = self.client.get(
+            '/api/v1/users_data',
+            headers={'If-None-Match': resp.headers['ETag']},
+        )
+        self.assertEqual(resp.status_code, 304)
+
+    def test_conditional_get_after_data_change(self):
+        """
+        Test ETag changes together with data file.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        data_csv = os.path.join(temp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, data_csv)
+        main.app.config.update({'DATA_CSV': data_csv})
+
+        etag = self.client.get('/api/v1/users').headers['ETag']
+        with open(data_csv, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-12,10:00:00,16:00:00\n')
+        resp = self.client.get(
+            '/api/v1/users',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(json.loads(resp.data)), 3)
+
+    def test_conditional_get_last_modified(self):
+        """
+        Test Last-Modified is rounded up and not sent for the current second.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        data_csv = os.path.join(temp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, data_csv)
+        main.app.config.update({'DATA_CSV': data_csv})
+
+        os.utime(data_csv, (1400000000.5, 1400000000.5))
+        resp = self.client.get('/api/v1/users')
+        last_modified = resp.headers['Last-Modified']
+        self.assertEqual(last_modified, 'Tue, 13 May 2014 16:53:21 GMT')
+
+        # second write within the same second
+        os.utime(data_csv, (1400000000.75, 1400000000.75))
+        resp = self.client.get(
+            '/api/v1/users',
+            headers={
+                'If-Modified-Since': last_modified,
+                'If-None-Match': resp.headers['ETag'],
+            },
+        )
+        self.assertEqual(resp.status_code, 200)
+
+        os.utime(data_csv, (time.time() + 1, time.time() + 1))
+        resp = self.client.get('/api/v1/users')
+        self.assertNotIn('Last-Modified', resp.headers)
+
+    def test_stale_data_response(self):
+        """
+        Test response built from outdated data during reload is neither
+        cached nor given ETag of the new data file.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        data_csv = os.path.join(temp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, data_csv)
+        main.app.config.update({'DATA_CSV': data_csv})
+        utils.CACHE_TIMESTAMP.clear()
+        utils.TAIL_STATE.clear()
+        self.addCleanup(utils.TAIL_STATE.clear)
+        self.addCleanup(utils.CACHE_TIMESTAMP.clear)
+        url = '/api/v1/presence_weekday/10'
+        self.assertEqual(json.loads(self.client.get(url).data)[1], ['Mon', 0])
+
+        read_presence_tail = utils.read_presence_tail
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_read(path, state):
+            """
+            Blocks reload until released.
+            """
+            started.set()
+            release.wait()
+            return read_presence_tail(path, state)
+
+        utils.read_presence_tail = slow_read
+        self.addCleanup(
+            setattr, utils, 'read_presence_tail', read_presence_tail,
+        )
+        with open(data_csv, 'a') as csvfile:
+            csvfile.write('\n10,2013-09-09,10:00:00,11:00:00\n')
+        worker = threading.Thread(target=utils.get_data)
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(release.set)
+        started.wait()
+        resp = self.client.get(url)
+        self.assertEqual(json.loads(resp.data)[1], ['Mon', 0])
+        self.assertNotIn('ETag', resp.headers)
+        release.set()
+        worker.join()
+
+        resp = self.client.get(url)
+        self.assertEqual(json.loads(resp.data)[1], ['Mon', 3600])
+        resp = self.client.get(
+            url, headers={'If-None-Match': resp.headers['ETag']},
+        )
+        self.assertEqual(resp.status_code, 304)
+
+    def test_response_cache(self):
+        """
+        Test serialized responses are cached and served compressed.
+        """
+        utils.RESPONSE_CACHE.clear()
+        stats = utils.response_cache_stats()
+        resp = self.client.get('/api/v1/group_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(resp.content_encoding)
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        body = resp.data
+
+        resp = self.client.get(
+            '/api/v1/group_weekday',
+            headers={'Accept-Encoding': 'gzip, deflate'},
+        )
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertEqual(
+            GzipFile(fileobj=StringIO(resp.data)).read(),
+            body,
+        )
+
+        new_stats = json.loads(self.client.get('/api/v1/cache_stats').data)
+        self.assertEqual(new_stats['hits'], stats['hits'] + 1)
+        self.assertEqual(new_stats['misses'], stats['misses'] + 1)
+        self.assertEqual(new_stats['entries'], 1)
+        self.assertGreater(new_stats['hit_rate'], 0)
+
+    def test_metrics_view(self):
+        """
+        Test metrics are exposed in Prometheus text format.
+        """
+        metrics.reset()
+        utils.CACHE_TIMESTAMP.clear()
+        utils.TAIL_STATE.clear()
+        utils.RESPONSE_CACHE.clear()
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/presence_weekday/11')
+
+        resp = self.client.get('/api/v1/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        lines = resp.data.splitlines()
+        self.assertIn(
+            '# TYPE presence_http_request_duration_seconds histogram', lines,
+        )
+        self.assertIn(
+            'presence_http_request_duration_seconds_count'
+            '{route="/api/v1/presence_weekday/<int:user_id>"} 2',
+            lines,
+        )
+        self.assertIn(
+            'presence_http_request_duration_seconds_bucket'
+            '{route="/api/v1/presence_weekday/<int:user_id>",le="+Inf"} 2',
+            lines,
+        )
+        self.assertIn(
+            'presence_cache_requests_total'
+            '{function="get_data",result="miss"} 1',
+            lines,
+        )
+        self.assertIn(
+            'presence_cache_requests_total'
+            '{function="get_weekday_stats",result="hit"} 1',
+            lines,
+        )
+        self.assertIn(
+            'presence_csv_rows_total{loader="get_data",mode="full"} 9',
+            lines,
+        )
+        self.assertIn('# TYPE presence_response_cache_bytes gauge', lines)
+
+    def test_profiling(self):
+        """
+        Test selected requests are profiled when profiling is enabled.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        wsgi_app = main.app.wsgi_app
+        self.addCleanup(setattr, main.app, 'wsgi_app', wsgi_app)
+        profiling.enable_profiling(main.app, temp_dir)
+        self.assertNotIsInstance(
+            main.app.wsgi_app, profiling.ProfilingMiddleware,
+        )
+
+        main.app.config.update({'PROFILING': True})
+        self.addCleanup(main.app.config.pop, 'PROFILING')
+        profiling.enable_profiling(main.app, temp_dir)
+        profiling.enable_profiling(main.app, temp_dir)
+        self.assertEqual(main.app.wsgi_app.wsgi_app, wsgi_app)
+
+        self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(os.listdir(temp_dir), [])
+        resp = self.client.get('/api/v1/presence_weekday/10?profile')
+        self.assertEqual(resp.status_code, 200)
+        for _ in range(2):
+            self.client.get(
+                '/api/v1/median_weekday/10', headers={'X-Profile': '1'},
+            )
+        names = os.listdir(temp_dir)
+        self.assertEqual(len(names), 6)
+        txt_names = [
+            name for name in names
+            if name.endswith('-GET-api_v1_median_weekday_10.txt')
+        ]
+        self.assertEqual(len(txt_names), 2)
+        name = txt_names[0]
+        self.assertIn(name[:-4] + '.prof', names)
+        self.assertIn('-{0}-'.format(os.getpid()), name)
+        with open(os.path.join(temp_dir, name)) as summary:
+            self.assertIn('cumulative', summary.read())
+
+    def test_response_cache_eviction(self):
+        """
+        Test response cache stays within its size limit.
+        """
+        utils.RESPONSE_CACHE.clear()
+        utils.RESPONSE_CACHE_STATS['bytes'] = 0
+        self.client.get('/api/v1/median_weekday/10')
+        limit = utils.RESPONSE_CACHE_STATS['bytes'] * 3 / 2
+        main.app.config.update({'RESPONSE_CACHE_BYTES': limit})
+        self.addCleanup(main.app.config.pop, 'RESPONSE_CACHE_BYTES')
+        self.client.get('/api/v1/median_weekday/11')
+        self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(len(utils.RESPONSE_CACHE), 1)
+        self.assertLessEqual(utils.RESPONSE_CACHE_STATS['bytes'], limit)
+
+    def test_benchmark_endpoints(self):
+        """
+        Test benchmark times every API endpoint.
+        """
+        adapter = main.app.url_map.bind('localhost')
+        timed = set(
+            adapter.match(endpoint.split('?')[0].format(
+                user_id=10, day='2013-09-10',
+            ))[0]
+            for endpoint in benchmark.ENDPOINTS
+        )
+        api = set(
+            rule.endpoint for rule in main.app.url_map.iter_rules()
+            if rule.rule.startswith('/api/v1/')
+        )
+        self.assertEqual(api - timed, set())
+
+        utils.RESPONSE_CACHE.clear()
+        results = benchmark.benchmark_endpoints(2)
+        self.assertItemsEqual(results.keys(), benchmark.ENDPOINTS)
+        self.assertEqual(len(utils.RESPONSE_CACHE), 0)
+        self.assertNotIn('RESPONSE_CACHE_BYTES', main.app.config)
+
+        utils.RESPONSE_CACHE['key'] = ('body', 'compressed')
+        benchmark.forget_loaded_data()
+        self.assertEqual(len(utils.RESPONSE_CACHE), 0)
+        self.assertEqual(utils.response_cache_stats()['hits'], 0)
+
     def test_page_to_display(self):
         """
         Test showing chosen page, including "error 404".
@@ -214,27 +779,361 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(('get_data' in utils.CACHE_TIMESTAMP), True)
 
         expected_data = {
-            datetime.date(2013, 9, 10): {
-                'start': datetime.time(9, 39, 5),
-                'end': datetime.time(17, 59, 52)
-            },
-            datetime.date(2013, 9, 12): {
-                'start': datetime.time(10, 48, 46),
-                'end': datetime.time(17, 23, 51)
-            },
-            datetime.date(2013, 9, 11): {
-                'start': datetime.time(9, 19, 52),
-                'end': datetime.time(16, 7, 37)
-            }
+            datetime.date(2013, 9, 10): utils.PresenceEntry(34745, 64792),
+            datetime.date(2013, 9, 12): utils.PresenceEntry(38926, 62631),
+            datetime.date(2013, 9, 11): utils.PresenceEntry(33592, 58057),
         }
         self.assertEqual(utils.CACHE_DATA['get_data'][10], expected_data)
 
         del utils.CACHE_DATA['get_data'][10]
         self.assertEqual((10 in utils.CACHE_DATA['get_data']), False)
         utils.CACHE_TIMESTAMP['get_data'] = 0
+        # unchanged file is not parsed again, forget what was read so far
+        utils.TAIL_STATE.clear()
         utils.get_data()
         self.assertEqual(utils.CACHE_DATA['get_data'][10], expected_data)
 
+    def test_memoize_arguments_and_eviction(self):
+        """
+        Test caching per call arguments with LRU eviction.
+        """
+        calls = []
+
+        @utils.memoize(600, max_size=2)
+        def square(number):
+            """
+            Cached test function.
+            """
+            calls.append(number)
+            return number * number
+
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(2), 4)
+        self.assertEqual(calls, [2, 3])
+        self.assertIn(('square', (2,), ()), utils.CACHE_DATA)
+
+        square(4)
+        self.assertNotIn(('square', (3,), ()), utils.CACHE_DATA)
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(calls, [2, 3, 4, 3])
+
+    def test_memoize_file_change(self):
+        """
+        Test cache invalidation after watched file changes.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        watched = os.path.join(temp_dir, 'watched.txt')
+        with open(watched, 'w') as watched_file:
+            watched_file.write('first')
+        main.app.config.update({'WATCHED_FILE': watched})
+
+        @utils.memoize(600, files=('WATCHED_FILE',))
+        def read_watched():
+            """
+            Cached test function.
+            """
+            with open(main.app.config['WATCHED_FILE']) as watched_file:
+                return watched_file.read()
+
+        self.assertEqual(read_watched(), 'first')
+        with open(watched, 'w') as watched_file:
+            watched_file.write('second')
+        self.assertEqual(read_watched(), 'second')
+
+    def test_memoize_serves_stale_value(self):
+        """
+        Test only one thread recomputes outdated value.
+        """
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @utils.memoize(600)
+        def slow():
+            """
+            Cached test function.
+            """
+            calls.append(1)
+            if len(calls) > 1:
+                started.set()
+                release.wait()
+            return len(calls)
+
+        self.assertEqual(slow(), 1)
+        utils.CACHE_TIMESTAMP['slow'] = 0
+        worker = threading.Thread(target=slow)
+        worker.start()
+        started.wait()
+        self.assertEqual(slow(), 1)
+        release.set()
+        worker.join()
+        self.assertEqual(slow(), 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_derived_from_concurrent_eviction(self):
+        """
+        Test derived results are served correctly by concurrent threads
+        while older ones are evicted.
+        """
+        source = object()
+        errors = []
+
+        @utils.derived_from(lambda: source, max_size=2)
+        def squared(data, number):
+            """
+            Derived test function.
+            """
+            self.assertIs(data, source)
+            return number * number
+
+        def worker(first):
+            """
+            Calls derived function with many different arguments.
+            """
+            try:
+                for number in range(first, first + 300):
+                    self.assertEqual(squared(number % 7), (number % 7) ** 2)
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+        workers = [
+            threading.Thread(target=worker, args=(idx,)) for idx in range(8)
+        ]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(
+            len(utils.DERIVED_DATA['squared']['results']), 2,
+        )
+        del utils.DERIVED_DATA['squared']
+
+    def test_get_data_partitions(self):
+        """
+        Test loading partition files, parsing only changed ones.
+        """
+        expected = utils.get_data()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.addCleanup(utils.CACHE_TIMESTAMP.clear)
+        self.addCleanup(utils.PARTITION_STATE.clear)
+        with open(TEST_DATA_CSV) as csvfile:
+            lines = csvfile.read().splitlines(True)
+        for name, part in (('2013-08.csv', lines[:4]),
+                           ('2013-09.csv', lines[4:])):
+            with open(os.path.join(temp_dir, name), 'w') as partition:
+                partition.writelines(part)
+        main.app.config.update({'DATA_CSV': temp_dir, 'DATA_WORKERS': 2})
+        self.addCleanup(main.app.config.pop, 'DATA_WORKERS')
+        self.assertEqual(utils.get_data(), expected)
+        state = utils.PARTITION_STATE[('get_data', temp_dir)]
+        first = state['partitions'][os.path.join(temp_dir, '2013-08.csv')]
+
+        with open(os.path.join(temp_dir, '2013-09.csv'), 'a') as partition:
+            partition.write('\n12,2013-09-12,10:00:00,16:00:00\n')
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [10, 11, 12])
+        state = utils.PARTITION_STATE[('get_data', temp_dir)]
+        self.assertIs(
+            state['partitions'][os.path.join(temp_dir, '2013-08.csv')],
+            first,
+        )
+
+        main.app.config.update({
+            'DATA_CSV': os.path.join(temp_dir, '2013-08*'),
+        })
+        self.assertEqual(
+            sum(len(items) for items in utils.get_data().itervalues()), 4,
+        )
+
+    def test_worker_metrics(self):
+        """
+        Test bad lines counted by worker processes are reported.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.addCleanup(utils.CACHE_TIMESTAMP.clear)
+        self.addCleanup(utils.PARTITION_STATE.clear)
+        self.addCleanup(metrics.reset)
+        for name in ('2013-08.csv', '2013-09.csv'):
+            with open(os.path.join(temp_dir, name), 'w') as partition:
+                partition.write(
+                    'header\n10,2013-09-10,09:39:05,17:59:52\n'
+                    '10,2013-09-1x,09:39:05,17:59:52\n'
+                )
+        main.app.config.update({'DATA_CSV': temp_dir, 'DATA_WORKERS': 2})
+        self.addCleanup(main.app.config.pop, 'DATA_WORKERS')
+        metrics.reset()
+        utils.get_data()
+        bad_lines = 'presence_csv_bad_lines_total'
+
+        def csv_counters():
+            """
+            Returns values of counters of parsed and skipped lines.
+            """
+            return dict(
+                (key, value)
+                for key, value in metrics.counter_values().iteritems()
+                if key[0].startswith('presence_csv_')
+            )
+
+        values = csv_counters()
+        self.assertEqual(values[(bad_lines, (('reason', 'columns'),))], 2)
+        self.assertEqual(values[(bad_lines, (('reason', 'format'),))], 2)
+
+        metrics.reset()
+        main.app.config.update({'DATA_WORKERS': 1})
+        utils.CACHE_TIMESTAMP.clear()
+        utils.PARTITION_STATE.clear()
+        utils.get_data()
+        self.assertEqual(csv_counters(), values)
+
+    def test_parse_presence_columns(self):
+        """
+        Test columns sliced from lines match the ones of parsed rows.
+        """
+        lines = [
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '10,2013-09-10,24:00:00,17:59:52\n',
+            '11,2013-02-30,09:00:00,17:00:00\n',
+            '11,2013-09-1x,09:00:00,17:00:00\n',
+            '11,2013-9-11,9:00:00,17:00:00\n',
+            '12,2013-09-11,07:00:00,23:59:59',
+        ]
+        columns = utils.parse_presence_columns(lines)
+        # pylint: disable=protected-access
+        self.assertEqual(
+            [column.tolist() for column in columns],
+            [
+                column.tolist() for column in utils._rows_to_columns(
+                    utils.parse_presence_lines(lines),
+                )
+            ],
+        )
+        self.assertEqual(columns[0].tolist(), [10, 11, 12])
+        self.assertEqual(columns[3].tolist(), [64792, 61200, 86399])
+
+    def test_worker_locks(self):
+        """
+        Test workers do not hang on locks held at fork time.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        paths = []
+        for name in ('2013-08.csv', '2013-09.csv'):
+            paths.append(os.path.join(temp_dir, name))
+            with open(paths[-1], 'w') as partition:
+                partition.write('10,2013-09-10,09:39:05,17:59:52\n')
+        main.app.config.update({'DATA_WORKERS': 2})
+        self.addCleanup(main.app.config.pop, 'DATA_WORKERS')
+
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            """
+            Holds metrics lock until released.
+            """
+            with metrics.LOCK:
+                held.set()
+                release.wait()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        self.addCleanup(holder.join)
+        self.addCleanup(release.set)
+        held.wait()
+        results = []
+        # pylint: disable=protected-access
+        loader = threading.Thread(
+            target=lambda: results.append(utils._parse_partitions(paths)),
+        )
+        loader.daemon = True
+        loader.start()
+        # parent process itself needs the lock to add worker counters
+        threading.Timer(1, release.set).start()
+        loader.join(30)
+        self.assertFalse(loader.is_alive())
+        self.assertEqual(
+            [columns[0].tolist() for columns in results[0]], [[10], [10]],
+        )
+
+    def test_parallel_parsing(self):
+        """
+        Test parsing newline-aligned ranges of CSV file in parallel.
+        """
+        _, serial_state, _ = utils.read_presence_tail(TEST_DATA_CSV, None)
+        expected = utils.get_data()
+        main.app.config.update({
+            'DATA_WORKERS': 3,
+            'DATA_PARALLEL_MIN_BYTES': 0,
+        })
+        self.addCleanup(main.app.config.pop, 'DATA_WORKERS')
+        self.addCleanup(main.app.config.pop, 'DATA_PARALLEL_MIN_BYTES')
+        rows, state, reloaded = utils.read_presence_tail(TEST_DATA_CSV, None)
+        self.assertTrue(reloaded)
+        self.assertIsInstance(rows, utils.PresenceColumns)
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(state, serial_state)
+        utils.CACHE_TIMESTAMP.clear()
+        utils.TAIL_STATE.clear()
+        self.assertEqual(utils.get_data(), expected)
+
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            size = os.path.getsize(TEST_DATA_CSV)
+            # pylint: disable=protected-access
+            bounds = utils._chunk_bounds(csvfile, size, 3)
+            self.assertEqual(bounds[0], 0)
+            self.assertEqual(bounds[-1], size)
+            for bound in bounds[1:-1]:
+                csvfile.seek(bound - 1)
+                self.assertEqual(csvfile.read(1), '\n')
+
+    def test_get_data_incremental(self):
+        """
+        Test parsing only rows appended to CSV file since the last load.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.addCleanup(utils.CACHE_TIMESTAMP.clear)
+        data_csv = os.path.join(temp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, data_csv)
+        main.app.config.update({'DATA_CSV': data_csv})
+        utils.CACHE_TIMESTAMP.clear()
+
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [10, 11])
+        state = utils.TAIL_STATE[('get_data', data_csv)]['file']
+        self.assertEqual(
+            state['offset'],
+            state['size'] - len('11,2013-09-13,13:16:56,15:04:02'),
+        )
+
+        with open(data_csv, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-12,10:00:00,16:00:00\n')
+        utils.CACHE_TIMESTAMP.clear()
+        new_data = utils.get_data()
+        self.assertItemsEqual(new_data.keys(), [10, 11, 12])
+        self.assertIs(new_data[10], data[10])
+        self.assertNotIn(12, data)
+        self.assertEqual(
+            new_data[11][datetime.date(2013, 9, 13)].end,
+            54242,
+        )
+
+        utils.CACHE_TIMESTAMP.clear()
+        self.assertIs(utils.get_data(), new_data)
+
+        with open(data_csv, 'w') as csvfile:
+            csvfile.write('13,2013-09-12,10:00:00,16:00:00\n')
+        utils.CACHE_TIMESTAMP.clear()
+        self.assertItemsEqual(utils.get_data().keys(), [13])
+
     def test_get_data(self):
         """
         Test parsing of CSV file.
@@ -244,45 +1143,218 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
-        self.assertItemsEqual(data[10][sample_date].keys(), ['start', 'end'])
+        self.assertIsInstance(data[10][sample_date], utils.PresenceEntry)
+        self.assertEqual(data[10][sample_date].start, 34745)
+        self.assertEqual(data[10][sample_date].end, 64792)
+
+    def test_parse_presence_lines(self):
+        """
+        Test fixed-format parser and its fallback for other lines.
+        """
+        lines = [
+            'user_id,date,start,end\r\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '"11",2013-09-10,9:39:05,17:59:52\n',
+            '12,2013-09-31,09:39:05,17:59:52\n',
+            '13,2013-09-10,09:39:05,17:59:5',
+        ]
+        result = list(utils.parse_presence_lines(lines))
+        expected = [
+            (
+                10,
+                datetime.date(2013, 9, 10),
+                datetime.time(9, 39, 5),
+                datetime.time(17, 59, 52),
+            ),
+            (
+                11,
+                datetime.date(2013, 9, 10),
+                datetime.time(9, 39, 5),
+                datetime.time(17, 59, 52),
+            ),
+            (
+                13,
+                datetime.date(2013, 9, 10),
+                datetime.time(9, 39, 5),
+                datetime.time(17, 59, 5),
+            ),
+        ]
+        self.assertEqual(result, expected)
+
+    def test_get_weekday_stats(self):
+        """
+        Test statistics table is built once per data load.
+        """
+        stats = utils.get_weekday_stats()
+        self.assertItemsEqual(stats.keys(), [10, 11])
+        self.assertEqual(
+            stats[10]['sum'],
+            [0, 30047, 24465, 23705, 0, 0, 0],
+        )
+        self.assertEqual(
+            stats[10]['start'],
+            [0, 34745.0, 33592.0, 38926.0, 0, 0, 0],
+        )
+        self.assertIs(utils.get_weekday_stats(), stats)
+
+        utils.CACHE_TIMESTAMP.clear()
+        utils.TAIL_STATE.clear()
+        self.assertIsNot(utils.get_weekday_stats(), stats)
+
+    def test_range_weekday_stats(self):
+        """
+        Test date range statistics computed from prefix sums.
+        """
+        index = utils.get_date_index()
+        self.assertIs(utils.get_date_index(), index)
+        stats = utils.get_weekday_stats()
+        for user_id in (10, 11):
+            self.assertEqual(
+                utils.range_weekday_stats(
+                    index, user_id, 0, 10 ** 6, with_intervals=True,
+                ),
+                stats[user_id],
+            )
+        self.assertIsNone(utils.range_weekday_stats(index, 7, 0, 10 ** 6))
+
+        day = datetime.date(2013, 9, 11).toordinal()
+        result = utils.range_weekday_stats(index, 11, day, day)
+        self.assertEqual(result['count'], [0, 0, 1, 0, 0, 0, 0])
+        self.assertEqual(result['start'], [0, 0, 33206.0, 0, 0, 0, 0])
+        self.assertNotIn('intervals', result)
+        result = utils.range_weekday_stats(
+            index, 11, day, day, with_intervals=True,
+        )
+        self.assertEqual(result['intervals'][2], [25321])
+
+        self.assertIsNone(utils.parse_date_range({}))
+        self.assertEqual(
+            utils.parse_date_range({'from': '2013-09-11'}),
+            (day, datetime.date.max.toordinal()),
+        )
+        with self.assertRaises(ValueError):
+            utils.parse_date_range({'to': '11.09.2013'})
+
+    def test_occupancy_sweep(self):
+        """
+        Test single sweep over sorted start and end times.
+        """
+        self.assertEqual(
+            utils.occupancy_sweep([10, 20, 30], [20, 40, 50]),
+            (None, 2, 30),
+        )
+        timeline, peak, peak_time = utils.occupancy_sweep(
+            [0, 7200], [3600, 10800], 3600,
+        )
+        self.assertEqual(timeline[:4], [1, 0, 1, 0])
+        self.assertEqual((peak, peak_time), (1, 0))
+
+    def test_polish_sort_key(self):
+        """
+        Test sorting in Polish alphabetical order.
+        """
+        names = [
+            '\u017baneta K.', 'Zofia A.', '\u0141ukasz B.', 'lech C.',
+            '\u0106wik D.', 'Cezary E.', '\u0179enon F.', 'Dawid G.',
+        ]
+        self.assertEqual(
+            sorted(names, key=utils.polish_sort_key),
+            [
+                'Cezary E.', '\u0106wik D.', 'Dawid G.', 'lech C.',
+                '\u0141ukasz B.', 'Zofia A.', '\u0179enon F.',
+                '\u017baneta K.',
+            ],
+        )
+        self.assertEqual(
+            sorted(
+                ['\u017baneta A.', 'Fabian B.', '\xc9milia K.', 'Ewa C.',
+                 '\xd6zil D.', 'Olga E.'],
+                key=utils.polish_sort_key,
+            ),
+            ['\xc9milia K.', 'Ewa C.', 'Fabian B.', 'Olga E.', '\xd6zil D.',
+             '\u017baneta A.'],
+        )
+
+    def test_get_users_data(self):
+        """
+        Test users are parsed again only after XML file changes.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        users_xml = os.path.join(temp_dir, 'users.xml')
+        shutil.copy(TEST_USER_XML, users_xml)
+        main.app.config.update({'USERS_XML_LOCAL_FILE': users_xml})
+        self.addCleanup(
+            main.app.config.update, {'USERS_XML_LOCAL_FILE': TEST_USER_XML},
+        )
+
+        users = utils.get_users_data()
+        self.assertEqual(len(users), 3)
+        self.assertIs(utils.get_users_data(), users)
+        self.assertIs(
+            utils.get_users_data_json(),
+            utils.get_users_data_json(),
+        )
+
+        with open(users_xml) as f_xml:
+            content = f_xml.read()
+        with open(users_xml, 'w') as f_xml:
+            f_xml.write(content.replace('Adam P.', 'Zenon P.'))
         self.assertEqual(
-            data[10][sample_date]['start'],
-            datetime.time(9, 39, 5)
+            [user['name'] for user in utils.get_users_data()],
+            ['Adrian K.', 'Agata J.', 'Zenon P.'],
         )
 
+    def test_generate_presence_csv(self):
+        """
+        Test synthetic presence data generator.
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        data_csv = os.path.join(temp_dir, 'data.csv')
+        rows = benchmark.generate_presence_csv(data_csv, 3, 1)
+        self.assertGreater(rows, 3 * 200)
+        parsed = list(utils.read_presence_rows(data_csv))
+        self.assertEqual(len(parsed), rows)
+        self.assertItemsEqual(set(row[0] for row in parsed), [1, 2, 3])
+        self.assertTrue(all(row[2] < row[3] for row in parsed))
+
+        users_xml = os.path.join(temp_dir, 'users.xml')
+        benchmark.generate_users_xml(users_xml, 3)
+        main.app.config.update({'USERS_XML_LOCAL_FILE': users_xml})
+        self.addCleanup(
+            main.app.config.update, {'USERS_XML_LOCAL_FILE': TEST_USER_XML},
+        )
+        self.assertEqual(
+            [user['user_id'] for user in utils.get_users_data()],
+            ['1', '2', '3'],
+        )
+
+    def test_benchmark_parallel_parsing(self):
+        """
+        Test parallel parsing benchmark covers 1, 2 and 4 workers.
+        """
+        self.addCleanup(main.app.config.update, {'COLUMNAR_STORE': False})
+        self.addCleanup(utils.CACHE_TIMESTAMP.clear)
+        results = benchmark.benchmark_parallel_parsing(TEST_DATA_CSV)
+        self.assertGreaterEqual(results['cpus'], 1)
+        for workers in (1, 2, 4):
+            self.assertIn(workers, results['dict'])
+        self.assertEqual(results['dict'][1]['speedup'], 1.0)
+        self.assertNotIn('DATA_WORKERS', main.app.config)
+
     def test_group_by_weekday(self):
         """
         Test groups presence entries by weekday.
         """
         sample_week = {
-            datetime.date(2015, 2, 2): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 0, 0)
-            },
-            datetime.date(2015, 2, 3): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 0, 0)
-            },
-            datetime.date(2015, 2, 4): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 0, 0)
-            },
-            datetime.date(2015, 2, 5): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 0, 0)
-            },
-            datetime.date(2015, 2, 6): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 0, 0)
-            },
-            datetime.date(2015, 2, 7): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(12, 0, 0)
-            },
-            datetime.date(2015, 2, 8): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(10, 0, 0)
-            },
+            datetime.date(2015, 2, 2): utils.PresenceEntry(32400, 61200),
+            datetime.date(2015, 2, 3): utils.PresenceEntry(32400, 61200),
+            datetime.date(2015, 2, 4): utils.PresenceEntry(32400, 61200),
+            datetime.date(2015, 2, 5): utils.PresenceEntry(32400, 61200),
+            datetime.date(2015, 2, 6): utils.PresenceEntry(32400, 61200),
+            datetime.date(2015, 2, 7): utils.PresenceEntry(32400, 43200),
+            datetime.date(2015, 2, 8): utils.PresenceEntry(32400, 36000),
         }
 
         result = utils.group_by_weekday(sample_week)
@@ -346,6 +1418,35 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         result = utils.mean(items)
         self.assertEqual(result, 2.975)
 
+    def test_percentile(self):
+        """
+        Test calculating percentiles of sorted list.
+        """
+        self.assertEqual(utils.percentile([], 50), 0.0)
+        self.assertEqual(utils.percentile([5], 90), 5.0)
+        self.assertEqual(utils.percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(utils.percentile([1, 2, 3, 4], 25), 1.75)
+        self.assertEqual(utils.percentile([10, 20, 30], 100), 30.0)
+
+    def test_histogram(self):
+        """
+        Test histogram of sorted list.
+        """
+        self.assertEqual(utils.histogram([], 10), [])
+        self.assertEqual(
+            utils.histogram([3, 5, 12, 35, 40], 10),
+            [[0, 2], [10, 1], [20, 0], [30, 1], [40, 1]],
+        )
+        self.assertEqual(
+            utils.histogram([-5, 5], 10),
+            [[-10, 1], [0, 1]],
+        )
+        if numpy is not None:
+            self.assertEqual(
+                utils.histogram(numpy.array([-5, 5]), 10),
+                [[-10, 1], [0, 1]],
+            )
+
     def test_median(self):
         """
         Test calculating median.
@@ -404,6 +1505,609 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
 # pylint: enable=import-error, no-name-in-module
 
 
+@requires_numpy
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Columnar store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'COLUMNAR_STORE': True,
+        })
+        utils.CACHE_TIMESTAMP.clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'COLUMNAR_STORE': False})
+        utils.CACHE_TIMESTAMP.clear()
+
+    def test_build_store(self):
+        """
+        Test sorting, deduplication and per-user index of columnar store.
+        """
+        result = store.build_store([
+            (11, 735000, 100, 200),
+            (10, 735001, 100, 300),
+            (10, 735000, 100, 400),
+            (10, 735001, 100, 500),
+        ])
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result.keys(), [10, 11])
+        self.assertIn(10, result)
+        self.assertNotIn(12, result)
+        self.assertEqual(result.day.tolist(), [735000, 735001, 735000])
+        self.assertEqual(result.interval.tolist(), [300, 400, 100])
+        self.assertEqual(result.user_slice(11), slice(2, 3))
+
+    def test_weekday_statistics(self):
+        """
+        Test columnar statistics match the ones computed on raw data.
+        """
+        data = utils.get_data()
+        presence_store = utils.get_store()
+        self.assertIsInstance(presence_store, store.PresenceStore)
+        for user_id in data:
+            weekdays = utils.group_by_weekday(data[user_id])
+            self.assertEqual(
+                [
+                    sorted(intervals.tolist())
+                    for intervals in presence_store.group_by_weekday(user_id)
+                ],
+                [sorted(intervals) for intervals in weekdays],
+            )
+            self.assertEqual(
+                presence_store.weekday_means(user_id),
+                [utils.mean(intervals) for intervals in weekdays],
+            )
+            self.assertEqual(
+                presence_store.weekday_sums(user_id),
+                [sum(intervals) for intervals in weekdays],
+            )
+            self.assertEqual(
+                presence_store.weekday_medians(user_id),
+                [utils.median(intervals) for intervals in weekdays],
+            )
+
+    def test_weekday_table(self):
+        """
+        Test vectorized statistics table matches the one built from dicts.
+        """
+        columnar = utils.get_weekday_stats()
+        main.app.config.update({'COLUMNAR_STORE': False})
+        utils.CACHE_TIMESTAMP.clear()
+        expected = utils.get_weekday_stats()
+        for user_stats in columnar.itervalues():
+            user_stats['intervals'] = [
+                intervals.tolist() for intervals in user_stats['intervals']
+            ]
+        self.assertEqual(columnar, expected)
+        self.assertEqual(
+            expected[10]['count'],
+            [0, 1, 1, 1, 0, 0, 0],
+        )
+
+    def test_views(self):
+        """
+        Test views return the same results with columnar store enabled.
+        """
+        urls = [
+            '/api/v1/users',
+            '/api/v1/mean_time_weekday/10',
+            '/api/v1/presence_weekday/10',
+            '/api/v1/presence_start_end/11',
+            '/api/v1/median_weekday/11',
+            '/api/v1/median_weekday/10000',
+            '/api/v1/percentiles_weekday/11?bin_width=600',
+            '/api/v1/bulk/presence_weekday',
+            '/api/v1/group_weekday',
+            '/api/v1/group_weekday?user_ids=11,12',
+            '/api/v1/heatmap/11?resolution=quarter',
+            '/api/v1/heatmap',
+            '/api/v1/occupancy/2013-09-12',
+            '/api/v1/occupancy?to=2013-09-11',
+            '/api/v1/presence_start_end/11?from=2013-09-09&to=2013-09-12',
+            '/api/v1/percentiles_weekday/11?to=2013-09-10&bin_width=600',
+            '/api/v1/bulk/mean_time_weekday?from=2013-09-11',
+        ]
+        columnar = [json.loads(self.client.get(url).data) for url in urls]
+        main.app.config.update({'COLUMNAR_STORE': False})
+        utils.CACHE_TIMESTAMP.clear()
+        utils.RESPONSE_CACHE.clear()
+        expected = [json.loads(self.client.get(url).data) for url in urls]
+        self.assertEqual(columnar, expected)
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.data_csv = os.path.join(self.temp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        main.app.config.update({
+            'DATA_CSV': self.data_csv,
+            'DATA_SNAPSHOT': True,
+        })
+        self.forget_loaded_data()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_SNAPSHOT': False,
+            'COLUMNAR_STORE': False,
+        })
+        self.forget_loaded_data()
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def forget_loaded_data():
+        """
+        Simulates fresh process start.
+        """
+        utils.CACHE_TIMESTAMP.clear()
+        utils.TAIL_STATE.clear()
+
+    def test_dict_snapshot(self):
+        """
+        Test presence dict is restored from snapshot and appended tail.
+        """
+        expected = utils.get_data()
+        self.assertTrue(os.path.exists(snapshot.snapshot_path(self.data_csv)))
+        self.forget_loaded_data()
+        self.assertEqual(utils.get_data(), expected)
+
+        with open(self.data_csv, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-12,10:00:00,16:00:00\n')
+        self.forget_loaded_data()
+        columns, state = snapshot.read_snapshot(self.data_csv)
+        self.assertEqual(len(columns[0]), 9)
+        self.assertEqual(state['identity'][1], os.stat(self.data_csv).st_ino)
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [10, 11, 12])
+        self.assertEqual(data[11], expected[11])
+
+    @requires_numpy
+    def test_store_snapshot(self):
+        """
+        Test columnar store is restored from memory-mapped snapshot.
+        """
+        main.app.config.update({'COLUMNAR_STORE': True})
+        client = main.app.test_client()
+        expected = client.get('/api/v1/bulk/median_weekday').data
+        self.forget_loaded_data()
+        utils.RESPONSE_CACHE.clear()
+        presence_store = utils.get_store()
+        self.assertIsInstance(presence_store.user_id, numpy.memmap)
+        self.assertEqual(
+            client.get('/api/v1/bulk/median_weekday').data,
+            expected,
+        )
+
+    def test_outdated_snapshot(self):
+        """
+        Test snapshot is ignored after CSV file was rewritten.
+        """
+        utils.get_data()
+        with open(self.data_csv, 'w') as csvfile:
+            csvfile.write('13,2013-09-12,10:00:00,16:00:00\n')
+        self.assertIsNone(snapshot.read_snapshot(self.data_csv))
+        self.forget_loaded_data()
+        self.assertItemsEqual(utils.get_data().keys(), [13])
+
+    def test_user_index(self):
+        """
+        Test cold single user requests read only lines of the user.
+        """
+        client = main.app.test_client()
+        urls = [
+            '/api/v1/presence_weekday/11',
+            '/api/v1/median_weekday/10?from=2013-09-11',
+            '/api/v1/percentiles_weekday/11?bin_width=600',
+            '/api/v1/mean_time_weekday/12',
+        ]
+        expected = [client.get(url).data for url in urls]
+        main.app.config.update({'DATA_INDEX': True})
+        self.addCleanup(main.app.config.pop, 'DATA_INDEX')
+        for key in ('get_data', 'get_store', 'get_shared_store'):
+            utils.CACHE_DATA.pop(key, None)
+        self.forget_loaded_data()
+        utils.RESPONSE_CACHE.clear()
+        self.assertTrue(utils.user_loading_enabled())
+        self.assertEqual([client.get(url).data for url in urls], expected)
+        self.assertNotIn('get_data', utils.CACHE_DATA)
+
+        index = user_index.update_index(self.data_csv)
+        self.assertItemsEqual(index['users'].keys(), [10, 11])
+        self.assertEqual(len(index['users'][10]), 1)
+        self.assertTrue(os.path.exists(user_index.index_path(self.data_csv)))
+        # unterminated last line is not indexed, but read anyway
+        self.assertEqual(len(utils.get_user_data(11)), 6)
+
+        with open(self.data_csv, 'a') as csvfile:
+            csvfile.write('\n10,2013-09-13,10:00:00,16:00:00\n')
+        index = user_index.update_index(self.data_csv)
+        self.assertEqual(index['offset'], os.path.getsize(self.data_csv))
+        self.assertEqual(len(index['users'][10]), 2)
+        self.assertEqual(len(utils.get_user_data(10)), 4)
+
+        client.get('/api/v1/bulk/presence_weekday')
+        self.assertFalse(utils.user_loading_enabled())
+
+    @requires_numpy
+    def test_shared_dataset(self):
+        """
+        Test workers attach to dataset published by loader process.
+        """
+        dataset = os.path.join(self.temp_dir, 'presence.dataset')
+        main.app.config.update({'SHARED_DATASET': dataset})
+        self.addCleanup(main.app.config.pop, 'SHARED_DATASET')
+        client = main.app.test_client()
+        expected = client.get('/api/v1/bulk/presence_weekday').data
+        self.assertIsNone(utils.get_shared_store())
+
+        self.assertTrue(utils.publish_shared_dataset())
+        self.assertFalse(utils.publish_shared_dataset())
+        self.forget_loaded_data()
+        utils.RESPONSE_CACHE.clear()
+        presence_store = utils.get_presence_source()
+        self.assertIsInstance(presence_store.day, numpy.memmap)
+        self.assertEqual(
+            client.get('/api/v1/bulk/presence_weekday').data,
+            expected,
+        )
+
+        # workers keep the old version until the new one is published
+        with open(self.data_csv, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-12,10:00:00,16:00:00\n')
+        utils.CACHE_TIMESTAMP.clear()
+        self.assertEqual(utils.get_presence_source().keys(), [10, 11])
+        self.assertTrue(utils.publish_shared_dataset())
+        resp = client.get('/api/v1/users')
+        self.assertEqual(
+            [user['user_id'] for user in json.loads(resp.data)],
+            [10, 11, 12],
+        )
+
+
+class UsersXMLHandler(BaseHTTPRequestHandler):
+    """
+    Serves users XML like the intranet does, failing when asked to.
+    """
+    body = b'<intranet><users></users></intranet>'
+    etag = '"v1"'
+    failures = 0
+    requests = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Answers GET request.
+        """
+        self.requests.append(dict(self.headers))
+        if UsersXMLHandler.failures:
+            UsersXMLHandler.failures -= 1
+            self.send_error(503)
+        elif self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', self.etag)
+            self.send_header('Content-Length', str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        """
+        Keeps test output clean.
+        """
+
+
+class PresenceAnalyzerBackendTestCase(unittest.TestCase):
+    """
+    Storage backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.data_csv = os.path.join(self.temp_dir, 'data.csv')
+        self.database = os.path.join(self.temp_dir, 'presence.sqlite')
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        main.app.config.update({
+            'DATA_CSV': self.data_csv,
+            'STORAGE_BACKEND': 'sqlite',
+            'SQLITE_DATABASE': self.database,
+        })
+        utils.CACHE_TIMESTAMP.clear()
+        utils.RESPONSE_CACHE.clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'STORAGE_BACKEND': 'csv',
+        })
+        del main.app.config['SQLITE_DATABASE']
+        utils.CACHE_TIMESTAMP.clear()
+        utils.TAIL_STATE.clear()
+        utils.RESPONSE_CACHE.clear()
+        backends.BACKENDS.clear()
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_backend(self):
+        """
+        Test backend is chosen by configuration.
+        """
+        backend = backends.get_backend()
+        self.assertIsInstance(backend, backends.SQLiteBackend)
+        self.assertIs(backends.get_backend(), backend)
+        main.app.config.update({'STORAGE_BACKEND': 'csv'})
+        self.assertIsInstance(backends.get_backend(), backends.CsvBackend)
+        main.app.config.update({'STORAGE_BACKEND': 'nosql'})
+        with self.assertRaises(ValueError):
+            backends.get_backend()
+
+    def test_views(self):
+        """
+        Test views return the same results with SQLite backend.
+        """
+        urls = [
+            '/api/v1/users',
+            '/api/v1/mean_time_weekday/10',
+            '/api/v1/presence_weekday/10',
+            '/api/v1/presence_start_end/11',
+            '/api/v1/median_weekday/11',
+            '/api/v1/median_weekday/10000',
+            '/api/v1/percentiles_weekday/11?bin_width=600',
+            '/api/v1/bulk/presence_weekday',
+            '/api/v1/bulk/median_weekday?user_ids=10,10000',
+            '/api/v1/group_weekday',
+            '/api/v1/group_weekday?user_ids=11,12',
+            '/api/v1/heatmap/11?resolution=quarter',
+            '/api/v1/heatmap',
+            '/api/v1/occupancy/2013-09-12',
+            '/api/v1/occupancy?to=2013-09-11',
+            '/api/v1/presence_start_end/11?from=2013-09-09&to=2013-09-12',
+            '/api/v1/mean_time_weekday/11?from=2014-01-01',
+            '/api/v1/percentiles_weekday/11?to=2013-09-10&bin_width=600',
+            '/api/v1/bulk/mean_time_weekday?from=2013-09-11',
+        ]
+        sqlite = [json.loads(self.client.get(url).data) for url in urls]
+        self.assertTrue(os.path.exists(self.database))
+        main.app.config.update({'STORAGE_BACKEND': 'csv'})
+        utils.RESPONSE_CACHE.clear()
+        expected = [json.loads(self.client.get(url).data) for url in urls]
+        self.assertEqual(sqlite, expected)
+
+    def test_large_group(self):
+        """
+        Test group of more users than SQLite query parameters limit.
+        """
+        backend = backends.get_backend()
+        user_ids = frozenset(range(11, 300000))
+        self.assertEqual(
+            backend.group_weekday_summary(user_ids),
+            backends.CsvBackend().group_weekday_summary(user_ids),
+        )
+        self.assertEqual(
+            backend.group_weekday_summary(frozenset(range(100, 300000)))[1][
+                'count'
+            ],
+            0,
+        )
+
+    def test_read_transaction(self):
+        """
+        Test all queries of one call see the same rows.
+        """
+        backend = backends.get_backend()
+        backend.user_ids()
+        imports = []
+        queries = []
+        import_csv = backends.import_csv
+        # pylint: disable=protected-access
+        execute = backend._execute
+
+        def counting_import(database):
+            """
+            Counts imports.
+            """
+            imports.append(database)
+            return import_csv(database)
+
+        def appending_execute(query, parameters=()):
+            """
+            Appends entry of a new user after the first query.
+            """
+            if len(queries) == 1:
+                with open(self.data_csv, 'a') as csvfile:
+                    csvfile.write('\n99,2013-09-09,08:00:00,16:00:00\n')
+            queries.append(query)
+            return execute(query, parameters)
+
+        self.addCleanup(setattr, backends, 'import_csv', import_csv)
+        backends.import_csv = counting_import
+        backend._execute = appending_execute
+        stats = backend.bulk_weekday_stats(
+            [10, 99], (0, 10 ** 6), with_intervals=True,
+        )
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(len(imports), 1)
+        self.assertIsNone(stats[99])
+        self.assertEqual(backend.weekday_stats(99)['count'][0], 1)
+
+    def test_bulk_weekday_stats(self):
+        """
+        Test statistics of many users take constant number of queries.
+        """
+        backend = backends.get_backend()
+        expected = backends.CsvBackend().bulk_weekday_stats(
+            [10, 11, 12], (735124, 735124),
+        )
+        self.assertEqual(
+            backend.bulk_weekday_stats([10, 11, 12], (735124, 735124)),
+            expected,
+        )
+        self.assertIsNone(expected[12])
+        self.assertEqual(expected[11]['count'], [0, 0, 0, 0, 1, 0, 0])
+        self.assertEqual(expected[10]['count'], [0] * 7)
+
+        queries = []
+        execute = backend._execute  # pylint: disable=protected-access
+
+        def counting_execute(query, parameters=()):
+            """
+            Counts executed queries.
+            """
+            queries.append(query)
+            return execute(query, parameters)
+
+        backend._execute = counting_execute  # pylint: disable=protected-access
+        stats = backend.bulk_weekday_stats(range(1000), with_intervals=True)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(stats[11]['intervals'][3], [22969, 22999])
+        del queries[:]
+        self.assertNotIn(
+            'intervals', backend.bulk_weekday_stats(range(1000))[10],
+        )
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(stats[10]['count'], [0, 1, 1, 1, 0, 0, 0])
+        self.assertIsNone(stats[12])
+
+    def test_incremental_import(self):
+        """
+        Test appended rows are imported and replaced file is reimported.
+        """
+        backend = backends.get_backend()
+        self.assertEqual(backend.user_ids(), [10, 11])
+        self.assertEqual(
+            backend.weekday_stats(11)['count'], [1, 1, 1, 2, 1, 0, 0],
+        )
+
+        with open(self.data_csv, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-12,10:00:00,16:00:00\n')
+        utils.CACHE_TIMESTAMP.clear()
+        self.assertEqual(backend.user_ids(), [10, 11, 12])
+        self.assertEqual(
+            backend.weekday_stats(11)['count'], [1, 1, 1, 2, 1, 0, 0],
+        )
+        self.assertEqual(backend.weekday_stats(12)['sum'][3], 21600)
+        self.assertIsNone(backend.weekday_stats(13))
+
+        os.remove(self.data_csv)
+        with open(self.data_csv, 'w') as csvfile:
+            csvfile.write('13,2013-09-12,10:00:00,11:00:00\n')
+        utils.CACHE_TIMESTAMP.clear()
+        self.assertEqual(backend.user_ids(), [13])
+
+
+class PresenceAnalyzerUsersCronTestCase(unittest.TestCase):
+    """
+    Users XML synchronization tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start local HTTP server.
+        """
+        UsersXMLHandler.failures = 0
+        UsersXMLHandler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), UsersXMLHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{0}/users.xml'.format(
+            self.server.server_port,
+        )
+        self.temp_dir = tempfile.mkdtemp()
+        self.users_xml = os.path.join(self.temp_dir, 'users.xml')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def get_users_xml(self, **kwargs):
+        """
+        Synchronizes users XML from local server without waiting.
+        """
+        return users_cron.get_users_xml(
+            self.url, self.users_xml, backoff=0, **kwargs
+        )
+
+    def test_conditional_download(self):
+        """
+        Test unchanged file is not downloaded again.
+        """
+        self.assertTrue(self.get_users_xml())
+        with open(self.users_xml, 'rb') as users_file:
+            self.assertEqual(users_file.read(), UsersXMLHandler.body)
+        self.assertFalse(self.get_users_xml())
+        self.assertEqual(
+            UsersXMLHandler.requests[-1].get('if-none-match'), '"v1"',
+        )
+        self.assertItemsEqual(
+            os.listdir(self.temp_dir),
+            ['users.xml', 'users.xml.validators'],
+        )
+
+        os.remove(self.users_xml)
+        self.assertTrue(self.get_users_xml())
+
+    def test_file_mode(self):
+        """
+        Test downloaded file is readable by others and keeps its mode.
+        """
+        self.assertTrue(self.get_users_xml())
+        self.assertEqual(os.stat(self.users_xml).st_mode & 0o777, 0o644)
+
+        os.chmod(self.users_xml, 0o640)
+        UsersXMLHandler.etag = '"v2"'
+        self.addCleanup(setattr, UsersXMLHandler, 'etag', '"v1"')
+        self.assertTrue(self.get_users_xml())
+        self.assertEqual(os.stat(self.users_xml).st_mode & 0o777, 0o640)
+
+    def test_retry(self):
+        """
+        Test failed downloads are retried and the local file is kept.
+        """
+        UsersXMLHandler.failures = 2
+        self.assertTrue(self.get_users_xml())
+        self.assertEqual(len(UsersXMLHandler.requests), 3)
+
+        UsersXMLHandler.failures = 5
+        UsersXMLHandler.etag = '"v2"'
+        self.addCleanup(setattr, UsersXMLHandler, 'etag', '"v1"')
+        with self.assertRaises(users_cron.urllib2.HTTPError):
+            self.get_users_xml(retries=1)
+        with open(self.users_xml, 'rb') as users_file:
+            self.assertEqual(users_file.read(), UsersXMLHandler.body)
+
+
 def suite():
     """
     Default test suite.
@@ -411,6 +2115,10 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerBackendTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUsersCronTestCase))
     return base_suite
 
 
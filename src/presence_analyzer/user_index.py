@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user byte ranges of presence CSV file.
+
+Index is kept next to the CSV file as JSON and maps user ids to
+[start, end) byte ranges of their lines, adjacent lines merged into one
+range. It covers the file up to the last complete line it has seen and
+is extended with lines appended since.
+"""
+import json
+import os
+import tempfile
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def index_path(csv_path):
+    """
+    Returns path of per-user index of given CSV file.
+    """
+    return csv_path + '.index'
+
+
+def line_user_id(line):
+    """
+    Returns user id of CSV line, None for lines without one.
+    """
+    try:
+        return int(line[:line.find(',')].strip('" '))
+    except ValueError:
+        return None
+
+
+def _read_index(csv_path):
+    """
+    Returns index stored next to CSV file, None when missing or broken.
+    """
+    try:
+        with open(index_path(csv_path)) as index_file:
+            index = json.load(index_file)
+        index['users'] = dict(
+            (int(user_id), ranges)
+            for user_id, ranges in index['users'].iteritems()
+        )
+        index['identity'] = tuple(index['identity'])
+        index['last_line'] = index['last_line'].encode('latin-1')
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+    return index
+
+
+def _write_index(csv_path, index):
+    """
+    Atomically writes index next to CSV file.
+    """
+    path = index_path(csv_path)
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp',
+    )
+    try:
+        with os.fdopen(handle, 'w') as index_file:
+            json.dump(
+                dict(index, last_line=index['last_line'].decode('latin-1')),
+                index_file,
+            )
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        log.warning('Cannot write index %s', path, exc_info=True)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _is_valid(csvfile, stat, index):
+    """
+    Tells whether index describes the beginning of opened CSV file.
+    """
+    if index['identity'] != (stat.st_dev, stat.st_ino) or \
+            stat.st_size < index['offset']:
+        return False
+    csvfile.seek(index['offset'] - len(index['last_line']))
+    return csvfile.read(len(index['last_line'])) == index['last_line']
+
+
+def _add_ranges(users, chunk, offset):
+    """
+    Adds byte ranges of lines of chunk starting at `offset` to users.
+    """
+    for line in chunk.splitlines(True):
+        user_id = line_user_id(line)
+        if user_id is not None:
+            ranges = users.setdefault(user_id, [])
+            if ranges and ranges[-1][1] == offset:
+                ranges[-1][1] = offset + len(line)
+            else:
+                ranges.append([offset, offset + len(line)])
+        offset += len(line)
+
+
+def update_index(csv_path):
+    """
+    Returns per-user index of CSV file, extended with lines appended since
+    it was stored (or built from scratch for new or replaced files).
+    """
+    index = _read_index(csv_path)
+    with open(csv_path, 'rb') as csvfile:
+        stat = os.fstat(csvfile.fileno())
+        if index is None or not _is_valid(csvfile, stat, index):
+            index = {
+                'identity': (stat.st_dev, stat.st_ino),
+                'offset': 0,
+                'last_line': '',
+                'users': {},
+            }
+        csvfile.seek(index['offset'])
+        chunk = csvfile.read()
+
+    consumed = chunk.rfind('\n') + 1
+    if consumed:
+        _add_ranges(index['users'], chunk[:consumed], index['offset'])
+        index['last_line'] = chunk[
+            chunk.rfind('\n', 0, consumed - 1) + 1:consumed
+        ]
+        index['offset'] += consumed
+        _write_index(csv_path, index)
+    return index
+
+
+def read_user_lines(csv_path, index, user_id):
+    """
+    Returns lines of given user: the indexed ones and the ones appended
+    after the index was updated.
+    """
+    lines = []
+    with open(csv_path, 'rb') as csvfile:
+        for start, end in index['users'].get(user_id, []):
+            csvfile.seek(start)
+            lines.extend(csvfile.read(end - start).splitlines(True))
+        csvfile.seek(index['offset'])
+        lines.extend(
+            line for line in csvfile.read().splitlines(True)
+            if line_user_id(line) == user_id
+        )
+    return lines
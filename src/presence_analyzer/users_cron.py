@@ -3,25 +3,140 @@
 Python script for cron.
 """
 
+import json
+import os
+import socket
+import tempfile
+import time
 import urllib2
-# pylint: disable=relative-import
-from config import (
+
+from presence_analyzer.config import (
     USERS_XML_REMOTE_FILE,
     USERS_XML_LOCAL_FILE
 )
 
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CHUNK_SIZE = 64 * 1024
+
+
+def validators_path(local_file):
+    """
+    Returns path of file keeping ETag and Last-Modified of local file.
+    """
+    return local_file + '.validators'
+
 
-def get_users_xml():
+def _read_validators(local_file):
+    """
+    Returns validators of the last download, empty dict if there are none.
+    """
+    if not os.path.exists(local_file):
+        return {}
+    try:
+        with open(validators_path(local_file)) as validators_file:
+            return json.load(validators_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_validators(local_file, headers):
+    """
+    Keeps ETag and Last-Modified response headers of the download.
+    """
+    validators = dict(
+        (name, headers[name])
+        for name in ('ETag', 'Last-Modified')
+        if headers.get(name)
+    )
+    with open(validators_path(local_file), 'w') as validators_file:
+        json.dump(validators, validators_file)
+
+
+def _download(remote_file, local_file, timeout):
+    """
+    Streams remote file into local file unless it has not changed.
+
+    Returns False on 304 Not Modified, True otherwise.
+    """
+    request = urllib2.Request(remote_file)
+    validators = _read_validators(local_file)
+    if 'ETag' in validators:
+        request.add_header('If-None-Match', validators['ETag'])
+    if 'Last-Modified' in validators:
+        request.add_header('If-Modified-Since', validators['Last-Modified'])
+    try:
+        f_remote = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            return False
+        raise
+
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(local_file)), suffix='.tmp',
+    )
+    try:
+        with os.fdopen(handle, 'wb') as f_local:
+            while True:
+                chunk = f_remote.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f_local.write(chunk)
+        # mkstemp creates 0600 files, keep the file readable by web server
+        try:
+            mode = os.stat(local_file).st_mode & 0o777
+        except OSError:
+            mode = 0o644
+        os.chmod(temp_path, mode)
+        # readers see either the old or the new file, never a partial one
+        os.rename(temp_path, local_file)
+    finally:
+        f_remote.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    _write_validators(local_file, f_remote.info())
+    return True
+
+
+def get_users_xml(remote_file=USERS_XML_REMOTE_FILE,
+                  local_file=USERS_XML_LOCAL_FILE,
+                  retries=3, backoff=1.0, timeout=30):
     """
     Download actual users data XML.
+
+    Conditional request is sent, so the file is not downloaded again while
+    it has not changed. Failed downloads are retried `retries` times,
+    waiting `backoff` seconds and twice as long after every next failure.
+    The local file is replaced atomically; running application notices
+    the new file by its size and mtime and reloads users data.
+
+    Returns True when the file was updated.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return _download(remote_file, local_file, timeout)
+        except urllib2.HTTPError as error:
+            if error.code < 500 or attempt == retries:
+                raise
+            log.warning('Downloading %s failed: %s', remote_file, error)
+        except (urllib2.URLError, socket.error) as error:
+            if attempt == retries:
+                raise
+            log.warning('Downloading %s failed: %s', remote_file, error)
+        time.sleep(backoff * 2 ** attempt)
+
+
+def main():
+    """
+    Updates users XML and logs the result.
     """
-    f_remote = urllib2.urlopen(USERS_XML_REMOTE_FILE)
-    data = f_remote.read()
-    with open(USERS_XML_LOCAL_FILE, "w") as f_local:
-        f_local.write(data)
-    f_remote.close()
-    return
+    logging.basicConfig(level=logging.INFO)
+    if get_users_xml():
+        log.info('Users XML updated')
+    else:
+        log.info('Users XML not modified')
 
 
 if __name__ == '__main__':
-    get_users_xml()
+    main()
@@ -1 +1 @@
-python ./users_cron.py
+cd "$(dirname "$0")/../.." && bin/update_users_xml_local_file
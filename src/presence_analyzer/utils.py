@@ -3,73 +3,411 @@
 Helper functions used in views.
 """
 
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import calendar
 import csv
+import glob
+import hashlib
+import multiprocessing
+import os
 from json import dumps
 from functools import wraps
-from datetime import datetime
+from itertools import izip
+from gzip import GzipFile
+from StringIO import StringIO
+from datetime import date as Date, datetime, time as Time
 import time
 import threading
-from flask import Response
+import unicodedata
+from flask import (
+    Response, g, has_request_context, make_response, request,
+)
+from lxml import etree
 
+from presence_analyzer import metrics
 from presence_analyzer.main import app
+from presence_analyzer.snapshot import (
+    read_dataset,
+    read_snapshot,
+    write_snapshot,
+)
+from presence_analyzer.store import PresenceStore, build_store, numpy
+from presence_analyzer.user_index import read_user_lines, update_index
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+POLISH_ALPHABET = u'0123456789aąbcćdeęfghijklłmnńoópqrsśtuvwxyzźż'
+POLISH_ORDER = dict((char, idx) for idx, char in enumerate(POLISH_ALPHABET))
+
 CACHE_TIMESTAMP = {}
 CACHE_DATA = {}
+CACHE_STAMP = {}
+TAIL_STATE = {}
+PARTITION_STATE = {}
+DERIVED_DATA = {}
+DERIVED_DATA_LOCK = threading.Lock()
+RESPONSE_CACHE = OrderedDict()
+RESPONSE_CACHE_LOCK = threading.Lock()
+RESPONSE_CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+# config keys of files presence data responses depend on
+DATA_FILES = ('DATA_CSV', 'SHARED_DATASET')
 
 
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    When the request has a data version (see `conditional`), serialized
+    and gzip-compressed representations are cached per version, and
+    wrapped function is called only on cache miss. Responses built from
+    outdated data (see `memoize`) are not cached.
     """
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
-        )
+        version = getattr(g, 'response_version', None)
+        entry = _cached_response(version) if version else None
+        if entry is None:
+            body = dumps(function(*args, **kwargs))
+            entry = (body, gzip_compress(body))
+            if version and not getattr(g, 'stale_data', False):
+                _cache_response(version, entry)
+
+        body, compressed = entry
+        response = Response(body, mimetype='application/json')
+        response.vary.add('Accept-Encoding')
+        if 'gzip' in request.accept_encodings and len(compressed) < len(body):
+            response.set_data(compressed)
+            response.content_encoding = 'gzip'
+        return response
     return inner
 
 
-def memoize(period_of_validity):
+def gzip_compress(data):
+    """
+    Returns gzip-compressed data.
+    """
+    buf = StringIO()
+    with GzipFile(fileobj=buf, mode='wb', mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buf.getvalue()
+
+
+def _cached_response(version):
+    """
+    Returns cached (body, compressed body) of response version or None.
+    """
+    with RESPONSE_CACHE_LOCK:
+        entry = RESPONSE_CACHE.pop(version, None)
+        if entry is None:
+            RESPONSE_CACHE_STATS['misses'] += 1
+            return None
+        RESPONSE_CACHE_STATS['hits'] += 1
+        RESPONSE_CACHE[version] = entry
+        return entry
+
+
+def _cache_response(version, entry):
+    """
+    Caches (body, compressed body) of response version.
+
+    Least recently used responses are evicted to keep the cache within
+    RESPONSE_CACHE_BYTES.
+    """
+    limit = app.config.get('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024)
+    size = len(entry[0]) + len(entry[1])
+    if size > limit:
+        return
+    with RESPONSE_CACHE_LOCK:
+        previous = RESPONSE_CACHE.pop(version, None)
+        if previous is not None:
+            RESPONSE_CACHE_STATS['bytes'] -= len(previous[0]) + \
+                len(previous[1])
+        RESPONSE_CACHE[version] = entry
+        RESPONSE_CACHE_STATS['bytes'] += size
+        while RESPONSE_CACHE_STATS['bytes'] > limit:
+            evicted = RESPONSE_CACHE.popitem(last=False)[1]
+            RESPONSE_CACHE_STATS['bytes'] -= len(evicted[0]) + \
+                len(evicted[1])
+            RESPONSE_CACHE_STATS['evictions'] += 1
+
+
+def response_cache_stats():
+    """
+    Returns response cache size, hit and eviction counters and hit rate.
+    """
+    with RESPONSE_CACHE_LOCK:
+        stats = dict(RESPONSE_CACHE_STATS, entries=len(RESPONSE_CACHE))
+    requests = stats['hits'] + stats['misses']
+    stats['hit_rate'] = float(stats['hits']) / requests if requests else 0.0
+    return stats
+
+
+def _response_cache_metrics():
+    """
+    Returns response cache statistics as metrics samples.
+    """
+    stats = response_cache_stats()
+    return [
+        (
+            'presence_response_cache_' + metric, metric_type,
+            'Response cache {0}.'.format(description), (), stats[name],
+        )
+        for name, metric, metric_type, description in (
+            ('hits', 'hits_total', 'counter', 'hits'),
+            ('misses', 'misses_total', 'counter', 'misses'),
+            ('evictions', 'evictions_total', 'counter', 'evictions'),
+            ('bytes', 'bytes', 'gauge', 'size in bytes'),
+            ('entries', 'entries', 'gauge', 'entries'),
+        )
+    ]
+
+
+metrics.add_collector(_response_cache_metrics)
+
+
+def _cache_key(function_id, args, kw):
+    """
+    Returns cache key of a call. Calls without arguments use function name.
+    """
+    if not args and not kw:
+        return function_id
+    return (function_id, args, tuple(sorted(kw.items())))
+
+
+def _files_stamp(config_keys):
+    """
+    Returns (path, size, mtime) of files which paths are stored in config.
+
+    Directories and glob patterns stand for all their partition files.
+    """
+    stamp = []
+    for config_key in config_keys:
+        path = app.config.get(config_key)
+        paths = partition_paths(path) if isinstance(path, basestring) \
+            else None
+        for path in paths if paths is not None else [path]:
+            try:
+                stat = os.stat(path)
+            except (OSError, TypeError):
+                stamp.append((path, None, None))
+            else:
+                stamp.append((path, stat.st_size, stat.st_mtime))
+    return tuple(stamp)
+
+
+def conditional(*files):
+    """
+    Decorator - answers conditional GET requests with 304 Not Modified.
+
+    ETag is derived from size and mtime of the files which paths are
+    stored under given config keys and from the request URL, so wrapped
+    view is not called at all when client already has its response.
+    Last-Modified is taken from the newest of the files and only checked
+    when the client does not send If-None-Match. The ETag is also
+    kept as `g.response_version` for `jsonify` response cache. Responses
+    built from outdated data get neither ETag nor Last-Modified.
+    """
+
+    def _conditional(function):
+        """
+        First inner function for decorator.
+        """
+
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            Second inner function for decorator.
+            """
+            stamp = _files_stamp(files)
+            etag = hashlib.sha1(repr((
+                stamp,
+                request.path,
+                sorted(request.args.items(multi=True)),
+            ))).hexdigest()
+            g.response_version = etag
+            mtimes = [mtime for _, _, mtime in stamp if mtime is not None]
+            last_modified = None
+            if mtimes:
+                # rounded up to whole seconds and sent only once that second
+                # has passed, so any later write gets a later Last-Modified
+                seconds = int(max(mtimes)) + 1
+                if seconds <= time.time():
+                    last_modified = datetime.utcfromtimestamp(seconds)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = last_modified is not None and \
+                    request.if_modified_since is not None and \
+                    last_modified <= request.if_modified_since
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = make_response(function(*args, **kwargs))
+
+            response.cache_control.no_cache = True
+            if getattr(g, 'stale_data', False):
+                # body does not match the data version of the files yet
+                return response
+            # weak, as the body may be sent gzip-compressed
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return inner
+    return _conditional
+
+
+def _count_cache_call(function, result):
+    """
+    Counts call of cached function by its result.
+    """
+    metrics.increment(
+        'presence_cache_requests_total',
+        (('function', function.__name__), ('result', result)),
+    )
+
+
+def _mark_stale():
+    """
+    Remembers that current request is served outdated data, so that its
+    response is not cached under the version of the current files.
+    """
+    if has_request_context():
+        g.stale_data = True
+
+
+def memoize(period_of_validity, files=(), max_size=128):
     """
     Decorator - aplies cache for wrapped function.
+
+    Results are cached per call arguments (which must be hashable) for
+    `period_of_validity` seconds, or until any of the files which paths
+    are stored under `files` config keys changes its size or mtime.
+    Only one thread recomputes an outdated entry, other ones are served
+    the outdated value meanwhile (and their responses are not cached).
+    At most `max_size` least recently used entries are kept.
     """
     lock = threading.Lock()
+    computing = {}
+    recent = OrderedDict()
 
     def _memoize(cached_func):
         """
         First inner function for decorator.
         """
 
+        @wraps(cached_func)
         def __memoize(*args, **kw):
             """
             Second inner function for decorator.
             """
-            function_id = cached_func.__name__
-            now = time.time()
-            with lock:
-                if (function_id in CACHE_TIMESTAMP) and \
-                   (CACHE_TIMESTAMP[function_id] +
-                   period_of_validity) > now:
-                    return CACHE_DATA[function_id]
+            key = _cache_key(cached_func.__name__, args, kw)
+            while True:
+                stamp = _files_stamp(files)
+                with lock:
+                    cached = key in CACHE_DATA and key in CACHE_TIMESTAMP
+                    if cached and CACHE_STAMP.get(key, ()) == stamp and \
+                       (CACHE_TIMESTAMP[key] +
+                       period_of_validity) > time.time():
+                        recent.pop(key, None)
+                        recent[key] = True
+                        _count_cache_call(cached_func, 'hit')
+                        return CACHE_DATA[key]
 
-                result = cached_func(*args, **kw)
-                CACHE_DATA[function_id] = result
+                    done = computing.get(key)
+                    if done is None:
+                        done = computing[key] = threading.Event()
+                        break
+                    if cached:
+                        _count_cache_call(cached_func, 'stale')
+                        _mark_stale()
+                        return CACHE_DATA[key]
+                # somebody else computes the first value, wait for it
+                done.wait()
+
+            _count_cache_call(cached_func, 'reload' if cached else 'miss')
 
-                CACHE_TIMESTAMP[function_id] = now
+            try:
+                now = time.time()
+                result = cached_func(*args, **kw)
+                with lock:
+                    CACHE_DATA[key] = result
+                    CACHE_TIMESTAMP[key] = now
+                    CACHE_STAMP[key] = stamp
+                    recent.pop(key, None)
+                    recent[key] = True
+                    while len(recent) > max_size:
+                        evicted = recent.popitem(last=False)[0]
+                        CACHE_DATA.pop(evicted, None)
+                        CACHE_TIMESTAMP.pop(evicted, None)
+                        CACHE_STAMP.pop(evicted, None)
                 return result
+            finally:
+                with lock:
+                    del computing[key]
+                done.set()
         return __memoize
     return _memoize
 
 
-@memoize(600)
+def derived_from(source, max_size=128):
+    """
+    Decorator - caches result computed from `source()` until it changes.
+
+    Wrapped function receives the current `source()` result followed by
+    call arguments and is called again only when source returns
+    a different object, i.e. after the underlying data was reloaded.
+    At most `max_size` results for different arguments are kept.
+    """
+
+    def _derived_from(derived_func):
+        """
+        First inner function for decorator.
+        """
+
+        @wraps(derived_func)
+        def __derived_from(*args):
+            """
+            Second inner function for decorator.
+            """
+            function_id = derived_func.__name__
+            data = source()
+            with DERIVED_DATA_LOCK:
+                cached = DERIVED_DATA.get(function_id)
+                if cached is None or cached['source'] is not data:
+                    result = 'miss' if cached is None else 'reload'
+                    cached = {'source': data, 'results': OrderedDict()}
+                    DERIVED_DATA[function_id] = cached
+                else:
+                    result = 'miss'
+                results = cached['results']
+                hit = args in results
+                value = results.get(args)
+            if hit:
+                _count_cache_call(derived_func, 'hit')
+                return value
+
+            # computed without the lock, concurrent callers may repeat it
+            value = derived_func(data, *args)
+            with DERIVED_DATA_LOCK:
+                results[args] = value
+                while len(results) > max_size:
+                    results.popitem(last=False)
+            _count_cache_call(derived_func, result)
+            return value
+        return __derived_from
+    return _derived_from
+
+
+@memoize(600, files=('DATA_CSV',))
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
@@ -77,36 +415,1277 @@ def get_data():
     It creates structure like this:
     data = {
         'user_id': {
-            datetime.date(2013, 10, 1): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
+            datetime.date(2013, 10, 1): PresenceEntry(32400, 63000),
+            datetime.date(2013, 10, 2): PresenceEntry(30600, 60300),
         }
     }
+    where entries hold start and end in seconds since midnight.
+
+    After cache expiry only rows appended to the file are parsed. DATA_CSV
+    may also be a directory or glob pattern of partition files, see
+    `load_partitions`.
+    """
+    paths = partition_paths(app.config['DATA_CSV'])
+    if paths is not None:
+        return load_partitions('get_data', paths, _dict_from_columns)
+    return load_presence_incrementally(
+        'get_data', _merge_into_dict, {},
+        snapshot=(_dict_to_columns, _dict_from_columns),
+    )
+
+
+class PresenceEntry(object):
+    """
+    Presence of user in a single day: start and end in seconds since
+    midnight.
+    """
+    __slots__ = ('start', 'end')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def __eq__(self, other):
+        return isinstance(other, PresenceEntry) and \
+            (self.start, self.end) == (other.start, other.end)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'PresenceEntry({0}, {1})'.format(self.start, self.end)
+
+
+def _merge_into_dict(data, rows):
+    """
+    Returns copy of presence dict with given rows merged in.
+
+    Only the dicts of users present in rows are copied, so structures
+    already handed out to views are never modified. Equal seconds share
+    one int object.
+    """
+    if not isinstance(rows, PresenceColumns):
+        rows = (
+            (
+                user_id, date,
+                seconds_since_midnight(start), seconds_since_midnight(end),
+            )
+            for user_id, date, start, end in rows
+        )
+    data = dict(data)
+    copied = set()
+    seconds = {}
+    for user_id, date, start, end in rows:
+        if user_id not in copied:
+            data[user_id] = dict(data.get(user_id, {}))
+            copied.add(user_id)
+        data[user_id][date] = PresenceEntry(
+            seconds.setdefault(start, start), seconds.setdefault(end, end),
+        )
+    return data
+
+
+def parse_presence_row(row):
+    """
+    Parses split CSV row with strptime.
+
+    Raises ValueError or TypeError for malformed rows.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
+    return (
+        int(row[0]),
+        datetime.strptime(row[1], '%Y-%m-%d').date(),
+        datetime.strptime(row[2], '%H:%M:%S').time(),
+        datetime.strptime(row[3], '%H:%M:%S').time(),
+    )
+
+
+def parse_presence_lines(lines, first_line=0):
+    """
+    Yields (user_id, date, start, end) tuples parsed from presence CSV lines.
+
+    Lines of the known `user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS` layout are
+    parsed by slicing, other ones go through `csv` and `parse_presence_row`.
+    """
+    dates = {}
+    for i, line in enumerate(lines, first_line):
+        line = line.rstrip('\r\n')
+        comma = line.find(',')
+        rest = line[comma + 1:]
+        if comma > 0 and len(rest) == 28 and rest[4] + rest[7] + rest[10] + \
+                rest[13] + rest[16] + rest[19] + rest[22] + rest[25] == \
+                '--,::,::':
+            try:
+                date = dates.get(rest[:10])
+                if date is None:
+                    date = dates[rest[:10]] = Date(
+                        int(rest[:4]), int(rest[5:7]), int(rest[8:10]),
+                    )
+                row = (
+                    int(line[:comma]),
+                    date,
+                    Time(int(rest[11:13]), int(rest[14:16]), int(rest[17:19])),
+                    Time(int(rest[20:22]), int(rest[23:25]), int(rest[26:28])),
+                )
+            except ValueError:
+                pass
+            else:
+                yield row
+                continue
+
+        for row in csv.reader([line], delimiter=','):
             if len(row) != 4:
                 # ignore header and footer lines
+                metrics.increment(
+                    'presence_csv_bad_lines_total', (('reason', 'columns'),),
+                )
                 continue
 
             try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
+                yield parse_presence_row(row)
             except (ValueError, TypeError):
                 log.debug('Problem with line %d: ', i, exc_info=True)
+                metrics.increment(
+                    'presence_csv_bad_lines_total', (('reason', 'format'),),
+                )
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
 
-    return data
+def read_presence_rows(path):
+    """
+    Yields (user_id, date, start, end) tuples parsed from presence CSV file.
+    """
+    with open(path, 'r') as csvfile:
+        for row in parse_presence_lines(csvfile):
+            yield row
+
+
+def read_presence_tail(path, state):
+    """
+    Reads presence rows appended to CSV file since given state was recorded.
+
+    Returns (rows, new_state, reloaded) where `reloaded` tells whether the
+    file had to be read from the beginning, because it is read for the
+    first time, was replaced or truncated. Unterminated last line is parsed
+    but not consumed, so it is read again once the writer finishes it.
+    """
+    with open(path, 'rb') as csvfile:
+        stat = os.fstat(csvfile.fileno())
+        identity = (stat.st_dev, stat.st_ino)
+        reloaded = (
+            state is None or
+            state['identity'] != identity or
+            stat.st_size < state['offset']
+        )
+        if not reloaded and state['last_line']:
+            csvfile.seek(state['offset'] - len(state['last_line']))
+            reloaded = csvfile.read(len(state['last_line'])) != \
+                state['last_line']
+        if not reloaded and (stat.st_size, stat.st_mtime) == \
+                (state['size'], state['mtime']):
+            return [], state, False
+
+        offset = 0 if reloaded else state['offset']
+        lines = 0 if reloaded else state['lines']
+        last_line = '' if reloaded else state['last_line']
+        workers = _parallel_workers(stat.st_size) if reloaded else 1
+        if workers > 1:
+            consumed, last_line = _last_complete_line(csvfile, stat.st_size)
+            rows, newlines = _parse_file_parallel(
+                csvfile, path, stat.st_size, workers,
+            )
+        else:
+            csvfile.seek(offset)
+            chunk = csvfile.read()
+
+    if workers < 2:
+        consumed = chunk.rfind('\n') + 1
+        if consumed:
+            last_line = chunk[
+                chunk.rfind('\n', 0, consumed - 1) + 1:consumed
+            ]
+        rows = list(parse_presence_lines(chunk.splitlines(True), lines))
+        newlines = chunk.count('\n', 0, consumed)
+    new_state = {
+        'identity': identity,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'offset': offset + consumed,
+        'lines': lines + newlines,
+        'last_line': last_line,
+    }
+    return rows, new_state, reloaded
+
+
+def _parallel_workers(size):
+    """
+    Returns number of processes to parse file of given size with: at most
+    DATA_WORKERS (number of CPUs by default), 1 for files smaller than
+    DATA_PARALLEL_MIN_BYTES.
+    """
+    if size < app.config.get('DATA_PARALLEL_MIN_BYTES', 16 * 1024 * 1024):
+        return 1
+    return app.config.get('DATA_WORKERS') or multiprocessing.cpu_count()
+
+
+class _WorkerTask(object):
+    """
+    Calls function in worker process and returns its result together with
+    metrics counters incremented meanwhile, lost with the process otherwise.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, item):
+        previous = metrics.counter_values()
+        result = self.function(item)
+        return result, metrics.counters_since(previous)
+
+
+def _reset_worker_locks():
+    """
+    Replaces locks inherited by a forked worker process. Any of them may
+    have been held by another thread of the parent at fork time, and
+    nobody would ever release it in the worker.
+    """
+    # pylint: disable=global-statement,protected-access
+    global DERIVED_DATA_LOCK, RESPONSE_CACHE_LOCK
+    metrics.LOCK = threading.Lock()
+    DERIVED_DATA_LOCK = threading.Lock()
+    RESPONSE_CACHE_LOCK = threading.Lock()
+    logging._lock = threading.RLock()
+    for handler in logging._handlerList:
+        handler = handler()
+        if handler is not None:
+            handler.createLock()
+
+
+def _pool_map(function, items, workers):
+    """
+    Returns `map(function, items)` computed by a pool of worker processes.
+
+    Metrics counters incremented by workers are added to the ones of the
+    calling process.
+    """
+    workers = min(workers, len(items))
+    if workers < 2:
+        return [function(item) for item in items]
+    pool = multiprocessing.Pool(workers, _reset_worker_locks)
+    try:
+        results = pool.map(_WorkerTask(function), items)
+    finally:
+        pool.close()
+        pool.join()
+    for _, increments in results:
+        metrics.add_counters(increments)
+    return [result for result, _ in results]
+
+
+def _last_complete_line(csvfile, size):
+    """
+    Returns (offset, line) of the end and content of the last line of file
+    which ends with a newline, (0, '') when there is none.
+    """
+    block = 64 * 1024
+    while True:
+        start = max(size - block, 0)
+        csvfile.seek(start)
+        tail = csvfile.read(size - start)
+        end = tail.rfind('\n') + 1
+        begin = tail.rfind('\n', 0, end - 1) + 1 if end else 0
+        if start == 0 or end and begin:
+            return (start + end, tail[begin:end]) if end else (0, '')
+        block *= 2
+
+
+def _chunk_bounds(csvfile, size, chunks):
+    """
+    Returns offsets splitting file into `chunks` ranges of whole lines.
+    """
+    bounds = [0]
+    for idx in range(1, chunks):
+        csvfile.seek(max(size * idx // chunks - 1, bounds[-1]))
+        csvfile.readline()
+        if csvfile.tell() > bounds[-1]:
+            bounds.append(min(csvfile.tell(), size))
+    if bounds[-1] < size:
+        bounds.append(size)
+    return bounds
+
+
+def parse_presence_range(task):
+    """
+    Returns (columns, number of newlines) of lines between (path, start,
+    end) byte offsets of presence CSV file.
+    """
+    path, start, end = task
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(start)
+        chunk = csvfile.read(end - start)
+    return (
+        parse_presence_columns(chunk.splitlines(True)),
+        chunk.count('\n'),
+    )
+
+
+def _parse_file_parallel(csvfile, path, size, workers):
+    """
+    Parses whole CSV file split into newline-aligned ranges in a pool of
+    worker processes. Returns (`PresenceColumns` rows, number of newlines).
+    """
+    bounds = _chunk_bounds(csvfile, size, workers)
+    results = _pool_map(
+        parse_presence_range,
+        [(path, start, end) for start, end in zip(bounds, bounds[1:])],
+        workers,
+    )
+    columns = (array('i'), array('i'), array('i'), array('i'))
+    for chunk_columns, _ in results:
+        for column, values in zip(columns, chunk_columns):
+            column.extend(values)
+    return PresenceColumns(columns), sum(count for _, count in results)
+
+
+class PresenceColumns(object):
+    """
+    Parsed presence rows kept as (user_id, day ordinal, start seconds, end
+    seconds) columns, cheap to pass between processes.
+
+    Iterates over (user_id, date, start seconds, end seconds) tuples,
+    sharing date objects.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        dates = {}
+        for user_id, day, start, end in izip(
+                *[column.tolist() for column in self.columns]):
+            date = dates.get(day)
+            if date is None:
+                date = dates[day] = Date.fromordinal(day)
+            yield user_id, date, start, end
+
+
+def load_presence_incrementally(name, merge, empty, snapshot=None):
+    """
+    Loads presence rows from CSV file merging them into structure `name`.
+
+    Only rows appended since the previous load are parsed and merged with
+    `merge(structure, rows)`. Structure is rebuilt starting from `empty`
+    when the file was replaced or truncated.
+
+    With DATA_SNAPSHOT enabled, `snapshot` is a pair of functions
+    converting the structure to columns and back. Cold load starts from
+    the snapshot when it matches the file and a new one is written after
+    the file was read from the beginning or has doubled since.
+    """
+    path = app.config['DATA_CSV']
+    key = (name, path)
+    use_snapshot = snapshot is not None and \
+        app.config.get('DATA_SNAPSHOT', False)
+    previous = TAIL_STATE.get(key)
+    if previous is None and use_snapshot:
+        previous = _load_snapshot(path, snapshot[1])
+    started = time.time()
+    rows, state, reloaded = read_presence_tail(
+        path, previous and previous['file'],
+    )
+    if state is not (previous and previous['file']):
+        labels = (('loader', name), ('mode', 'full' if reloaded else 'tail'))
+        metrics.observe(
+            'presence_csv_parse_seconds', time.time() - started, labels,
+        )
+        metrics.increment('presence_csv_rows_total', labels, len(rows))
+    snapshot_offset = previous['snapshot_offset'] if previous else 0
+    if reloaded:
+        log.debug('Loading %s from %s', name, path)
+        result = merge(empty, rows)
+        snapshot_offset = 0
+    elif rows:
+        log.debug('Merging %d new rows into %s', len(rows), name)
+        result = merge(previous['result'], rows)
+    else:
+        result = previous['result']
+    if use_snapshot and state['offset'] > 2 * snapshot_offset:
+        write_snapshot(path, snapshot[0](result), state)
+        snapshot_offset = state['offset']
+    TAIL_STATE[key] = {
+        'file': state,
+        'result': result,
+        'snapshot_offset': snapshot_offset,
+    }
+    return result
+
+
+def partition_paths(pattern):
+    """
+    Returns sorted partition files of directory (its *.csv files) or glob
+    pattern, None when `pattern` is a path of a single file.
+    """
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, '*.csv')))
+    if glob.has_magic(pattern):
+        return sorted(glob.glob(pattern))
+    return None
+
+
+def _rows_to_columns(rows):
+    """
+    Returns (user_id, day ordinal, start seconds, end seconds) columns of
+    parsed presence rows.
+    """
+    columns = (array('i'), array('i'), array('i'), array('i'))
+    for user_id, date, start, end in rows:
+        columns[0].append(user_id)
+        columns[1].append(date.toordinal())
+        columns[2].append(seconds_since_midnight(start))
+        columns[3].append(seconds_since_midnight(end))
+    return columns
+
+
+def _clock_seconds(text):
+    """
+    Returns seconds since midnight of HH:MM:SS text.
+
+    Raises ValueError for malformed or out of range times.
+    """
+    hour, minute, second = int(text[:2]), int(text[3:5]), int(text[6:8])
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        raise ValueError('time out of range: ' + text)
+    return hour * 3600 + minute * 60 + second
+
+
+def parse_presence_columns(lines):
+    """
+    Returns (user_id, day ordinal, start seconds, end seconds) columns
+    parsed from presence CSV lines.
+
+    Lines of the known layout are sliced straight into numbers, without
+    date and time objects, other ones go through `parse_presence_lines`.
+    """
+    columns = (array('i'), array('i'), array('i'), array('i'))
+    days = {}
+    seconds = {}
+    for i, line in enumerate(lines):
+        line = line.rstrip('\r\n')
+        comma = line.find(',')
+        rest = line[comma + 1:]
+        if comma > 0 and len(rest) == 28 and rest[4] + rest[7] + rest[10] + \
+                rest[13] + rest[16] + rest[19] + rest[22] + rest[25] == \
+                '--,::,::':
+            try:
+                user_id = int(line[:comma])
+                day = days.get(rest[:10])
+                if day is None:
+                    day = days[rest[:10]] = Date(
+                        int(rest[:4]), int(rest[5:7]), int(rest[8:10]),
+                    ).toordinal()
+                start = seconds.get(rest[11:19])
+                if start is None:
+                    start = seconds[rest[11:19]] = _clock_seconds(rest[11:19])
+                end = seconds.get(rest[20:])
+                if end is None:
+                    end = seconds[rest[20:]] = _clock_seconds(rest[20:])
+            except ValueError:
+                pass
+            else:
+                columns[0].append(user_id)
+                columns[1].append(day)
+                columns[2].append(start)
+                columns[3].append(end)
+                continue
+
+        for column, values in zip(
+                columns, _rows_to_columns(parse_presence_lines([line], i))):
+            column.extend(values)
+    return columns
+
+
+def parse_partition(path):
+    """
+    Returns (user_id, day ordinal, start seconds, end seconds) columns
+    parsed from presence CSV file.
+    """
+    with open(path, 'r') as csvfile:
+        return parse_presence_columns(csvfile)
+
+
+def _parse_partitions(paths):
+    """
+    Returns columns of every partition file, parsed by a process pool of
+    DATA_WORKERS (number of CPUs by default) when there are more of them.
+    """
+    return _pool_map(
+        parse_partition, paths,
+        app.config.get('DATA_WORKERS') or multiprocessing.cpu_count(),
+    )
+
+
+def load_partitions(name, paths, from_columns):
+    """
+    Loads presence rows from partition files into structure `name`.
+
+    Only partitions which are new or changed their size or mtime since
+    the previous load are parsed, in parallel. Structure is built with
+    `from_columns` from columns of all partitions in path order, so rows
+    of later partitions override earlier ones.
+    """
+    key = (name, app.config['DATA_CSV'])
+    previous = PARTITION_STATE.get(key, {'partitions': {}, 'result': None})
+    partitions = {}
+    changed = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        stamp = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+        known = previous['partitions'].get(path)
+        if known is not None and known[0] == stamp:
+            partitions[path] = known
+        else:
+            changed.append((path, stamp))
+    if not changed and previous['result'] is not None and \
+            len(partitions) == len(previous['partitions']):
+        return previous['result']
+
+    started = time.time()
+    parsed = _parse_partitions([path for path, _ in changed])
+    labels = (('loader', name), ('mode', 'partitions'))
+    metrics.observe(
+        'presence_csv_parse_seconds', time.time() - started, labels,
+    )
+    metrics.increment(
+        'presence_csv_rows_total', labels,
+        sum(len(columns[0]) for columns in parsed),
+    )
+    log.debug('Parsed %d of %d partitions of %s', len(changed),
+              len(changed) + len(partitions), name)
+    for (path, stamp), columns in zip(changed, parsed):
+        partitions[path] = (stamp, columns)
+
+    merged = (array('i'), array('i'), array('i'), array('i'))
+    for path in sorted(partitions):
+        for column, values in zip(merged, partitions[path][1]):
+            column.extend(values)
+    result = from_columns(merged)
+    PARTITION_STATE[key] = {'partitions': partitions, 'result': result}
+    return result
+
+
+def _load_snapshot(path, from_columns):
+    """
+    Returns loader state restored from snapshot of CSV file, if it is valid.
+    """
+    snapshot = read_snapshot(path, memory_map=columnar_enabled())
+    if snapshot is None:
+        return None
+    columns, state = snapshot
+    log.debug('Loaded %d rows from snapshot of %s', len(columns[0]), path)
+    return {
+        'file': state,
+        'result': from_columns(columns),
+        'snapshot_offset': state['offset'],
+    }
+
+
+def _dict_to_columns(data):
+    """
+    Returns columns of presence dict sorted by user and day.
+    """
+    columns = (array('i'), array('i'), array('i'), array('i'))
+    for user_id in sorted(data):
+        items = data[user_id]
+        for date in sorted(items):
+            columns[0].append(user_id)
+            columns[1].append(date.toordinal())
+            columns[2].append(items[date].start)
+            columns[3].append(items[date].end)
+    return columns
+
+
+def _dict_from_columns(columns):
+    """
+    Returns presence dict built from columns.
+    """
+    return _merge_into_dict({}, PresenceColumns(columns))
+
+
+def columnar_enabled():
+    """
+    Tells whether views should use the columnar `PresenceStore`.
+    """
+    return numpy is not None and app.config.get('COLUMNAR_STORE', False)
+
+
+def _merge_into_store(presence_store, rows):
+    """
+    Returns columnar store with given rows merged in.
+    """
+    if isinstance(rows, PresenceColumns):
+        return PresenceStore(*[
+            numpy.concatenate((old, new))
+            for old, new in zip(_store_to_columns(presence_store),
+                                rows.columns)
+        ])
+    return presence_store.extend(
+        (
+            user_id,
+            date.toordinal(),
+            seconds_since_midnight(start),
+            seconds_since_midnight(end),
+        )
+        for user_id, date, start, end in rows
+    )
+
+
+def _store_to_columns(presence_store):
+    """
+    Returns sorted columns of columnar store.
+    """
+    return (
+        presence_store.user_id,
+        presence_store.day,
+        presence_store.start,
+        presence_store.end,
+    )
+
+
+def _store_from_columns(columns):
+    """
+    Returns columnar store using (memory-mapped) sorted columns.
+    """
+    return PresenceStore.from_sorted(
+        *[numpy.asanyarray(column) for column in columns]
+    )
+
+
+@memoize(600, files=('DATA_CSV',))
+def get_store():
+    """
+    Extracts presence data from CSV file into columnar `PresenceStore`.
+
+    Returns None when columnar store is disabled or NumPy is not available,
+    in which case `get_data` should be used.
+    """
+    if not columnar_enabled():
+        return None
+    return _load_store()
+
+
+def _load_store():
+    """
+    Loads columnar store from CSV file, regardless of COLUMNAR_STORE.
+    """
+    paths = partition_paths(app.config['DATA_CSV'])
+    if paths is not None:
+        return load_partitions(
+            'get_store', paths, lambda columns: PresenceStore(*columns),
+        )
+    return load_presence_incrementally(
+        'get_store', _merge_into_store, build_store([]),
+        snapshot=(_store_to_columns, _store_from_columns),
+    )
+
+
+def publish_shared_dataset():
+    """
+    Writes presence data parsed from CSV file to SHARED_DATASET file.
+
+    Meant to be run by a single loader process; the file is replaced
+    atomically and only when CSV file has changed since the last run.
+    Returns True when new dataset was written. Raises ValueError for
+    partitioned DATA_CSV.
+    """
+    if partition_paths(app.config['DATA_CSV']) is not None:
+        raise ValueError('Shared dataset needs a single DATA_CSV file')
+    path = app.config['SHARED_DATASET']
+    presence_store = _load_store()
+    state = TAIL_STATE[('get_store', app.config['DATA_CSV'])]['file']
+    current = read_dataset(path, memory_map=True)
+    if current is not None:
+        published = current[1]['state']
+        if (tuple(published['identity']), published['size'],
+                published['mtime'], published['offset']) == \
+                (state['identity'], state['size'], state['mtime'],
+                 state['offset']):
+            return False
+    log.info('Publishing %d rows to %s', len(presence_store), path)
+    write_snapshot(
+        app.config['DATA_CSV'], _store_to_columns(presence_store), state,
+        path=path,
+    )
+    return True
+
+
+@memoize(600, files=('SHARED_DATASET',))
+def get_shared_store():
+    """
+    Attaches read-only to memory-mapped dataset written by
+    `publish_shared_dataset`, so all worker processes share one copy.
+
+    Returns None when SHARED_DATASET is not set, NumPy is not available
+    or the dataset has not been published yet. New version is picked up
+    once the file is swapped.
+    """
+    path = app.config.get('SHARED_DATASET')
+    if not path or numpy is None:
+        return None
+    dataset = read_dataset(path, memory_map=True)
+    if dataset is None:
+        log.warning('Shared dataset %s is not available', path)
+        return None
+    return PresenceStore.from_sorted(*dataset[0])
+
+
+def get_presence_source():
+    """
+    Returns shared dataset or columnar store if enabled, presence data
+    dict otherwise.
+    """
+    presence_store = get_shared_store()
+    if presence_store is not None:
+        return presence_store
+    presence_store = get_store()
+    return presence_store if presence_store is not None else get_data()
+
+
+@derived_from(get_presence_source)
+def get_weekday_stats(data):
+    """
+    Returns per user, per weekday statistics table of current presence data.
+
+    It creates structure like this:
+    stats = {
+        'user_id': {
+            'count': [2, 3, 0, 0, 0, 0, 0],
+            'sum': [57600, 86400, 0, 0, 0, 0, 0],
+            'mean': [28800.0, 28800.0, 0, 0, 0, 0, 0],
+            'start': [32400.0, 32400.0, 0, 0, 0, 0, 0],
+            'end': [61200.0, 61200.0, 0, 0, 0, 0, 0],
+            'intervals': [[28800, 28800], [27000, 28800, 30600], [], [],
+                          [], [], []],
+        }
+    }
+    where 'start' and 'end' are mean start and end in seconds since
+    midnight and 'intervals' are sorted presence times (NumPy arrays for
+    columnar store). The table is built once per data load.
+    """
+    if isinstance(data, PresenceStore):
+        return data.weekday_table()
+
+    return dict(
+        (user_id, user_weekday_stats(items))
+        for user_id, items in data.iteritems()
+    )
+
+
+def user_weekday_stats(items):
+    """
+    Returns weekday statistics of presence entries of a single user.
+    """
+    weekdays = group_by_weekday(items)
+    week = group_start_end_times_by_weekday(items)
+    return {
+        'count': [len(intervals) for intervals in weekdays],
+        'sum': [sum(intervals) for intervals in weekdays],
+        'mean': [mean(intervals) for intervals in weekdays],
+        'start': [mean(week[day]['start']) for day in week],
+        'end': [mean(week[day]['end']) for day in week],
+        'intervals': [sorted(intervals) for intervals in weekdays],
+    }
+
+
+@memoize(600, files=('DATA_CSV',))
+def get_user_index():
+    """
+    Returns per-user byte ranges index of CSV file, see `user_index`.
+    """
+    return update_index(app.config['DATA_CSV'])
+
+
+@memoize(600, files=('DATA_CSV',))
+def get_user_data(user_id):
+    """
+    Returns presence entries of a single user, as in `get_data`, reading
+    only lines of the user. Returns None for unknown users.
+    """
+    lines = read_user_lines(
+        app.config['DATA_CSV'], get_user_index(), user_id,
+    )
+    return _merge_into_dict({}, parse_presence_lines(lines)).get(user_id)
+
+
+def user_loading_enabled():
+    """
+    Tells whether single user requests should read only lines of the user:
+    DATA_INDEX is enabled, DATA_CSV is a single file and presence data of
+    all users has not been loaded yet.
+    """
+    if not app.config.get('DATA_INDEX', False) or \
+            partition_paths(app.config['DATA_CSV']) is not None:
+        return False
+    return all(
+        CACHE_DATA.get(key) is None
+        for key in ('get_data', 'get_store', 'get_shared_store')
+    )
+
+
+def get_user_weekday_stats(user_id, date_range=None):
+    """
+    Returns weekday statistics of a single user loaded by `get_user_data`,
+    limited to (first, last) day ordinals range if given. Returns None
+    for unknown users.
+    """
+    items = get_user_data(user_id)
+    if items is None:
+        return None
+    if date_range is not None:
+        first, last = date_range
+        items = dict(
+            (date, item) for date, item in items.iteritems()
+            if first <= date.toordinal() <= last
+        )
+    return user_weekday_stats(items)
+
+
+@derived_from(get_presence_source)
+def get_date_index(data):
+    """
+    Returns presence entries ordered by user, weekday and day together with
+    prefix sums, so statistics of any date range are cheap to compute.
+
+    It creates structure like this:
+    index = {
+        'groups': {'user_id': [(0, 2), (2, 5), (5, 5), ...]},
+        'day': [735000, 735007, 735001, ...],
+        'interval': [28800, 28800, 27000, ...],
+        'interval_sums': [0, 28800, 57600, 84600, ...],
+        'start_sums': [0, 32400, 64800, ...],
+        'end_sums': [0, 61200, 122400, ...],
+    }
+    where 'groups' holds, for every day in week, bounds of user's entries
+    in the flat columns, 'day' are day ordinals and '*_sums' are running
+    totals with a leading zero. The index is built once per data load.
+    """
+    if isinstance(data, PresenceStore):
+        return data.date_index()
+
+    index = {
+        'groups': {},
+        'day': array('i'),
+        'interval': array('i'),
+        'interval_sums': [0],
+        'start_sums': [0],
+        'end_sums': [0],
+    }
+    for user_id in sorted(data):
+        items = data[user_id]
+        weekdays = [[] for _ in range(7)]
+        for date in sorted(items):
+            weekdays[date.weekday()].append(date)
+        groups = index['groups'][user_id] = []
+        for dates in weekdays:
+            first = len(index['day'])
+            for date in dates:
+                start = items[date].start
+                end = items[date].end
+                index['day'].append(date.toordinal())
+                index['interval'].append(end - start)
+                index['interval_sums'].append(
+                    index['interval_sums'][-1] + end - start
+                )
+                index['start_sums'].append(index['start_sums'][-1] + start)
+                index['end_sums'].append(index['end_sums'][-1] + end)
+            groups.append((first, len(index['day'])))
+    return index
+
+
+def range_weekday_stats(index, user_id, first_day, last_day,
+                        with_intervals=False):
+    """
+    Returns weekday statistics of user's entries between given day
+    ordinals (both inclusive), None for unknown users.
+
+    Result has the structure of `get_weekday_stats` table row. Every
+    weekday takes two bisections and a few subtractions, sorted
+    'intervals' of the range are added only `with_intervals`.
+    """
+    if user_id not in index['groups']:
+        return None
+
+    days = index['day']
+    stats = {'count': [], 'sum': [], 'mean': [], 'start': [], 'end': []}
+    if with_intervals:
+        stats['intervals'] = []
+    for first, last in index['groups'][user_id]:
+        low = bisect_left(days, first_day, first, last)
+        high = bisect_right(days, last_day, low, last)
+        count = high - low
+
+        def range_sum(name):
+            """
+            Returns sum of column values of entries in range.
+            """
+            sums = index[name + '_sums']
+            return int(sums[high] - sums[low])
+
+        total = range_sum('interval')
+        stats['count'].append(count)
+        stats['sum'].append(total)
+        stats['mean'].append(float(total) / count if count else 0)
+        stats['start'].append(
+            float(range_sum('start')) / count if count else 0
+        )
+        stats['end'].append(float(range_sum('end')) / count if count else 0)
+        if with_intervals:
+            stats['intervals'].append(
+                sorted(index['interval'][low:high].tolist())
+            )
+    return stats
+
+
+def parse_date_range(args):
+    """
+    Parses `from` and `to` (YYYY-MM-DD, both inclusive) query arguments
+    into day ordinals. Returns None when neither is given.
+
+    Raises ValueError for malformed dates.
+    """
+    first = args.get('from')
+    last = args.get('to')
+    if first is None and last is None:
+        return None
+    return (
+        datetime.strptime(first, '%Y-%m-%d').toordinal()
+        if first else Date.min.toordinal(),
+        datetime.strptime(last, '%Y-%m-%d').toordinal()
+        if last else Date.max.toordinal(),
+    )
+
+
+@derived_from(get_presence_source)
+def get_group_weekday_summary(data, user_ids=None):
+    """
+    Returns weekday statistics of all presence entries of given users.
+
+    User ids are given as a frozenset, None means all users. It creates
+    structure like this:
+    summary = [
+        {
+            'weekday': 'Mon',
+            'count': 2,
+            'total': 57600,
+            'mean': 28800.0,
+            'median': 28800.0,
+            'start': {'mean': 32400.0, 'p25': 32400.0, 'median': 32400.0,
+                      'p75': 32400.0},
+            'end': {'mean': 61200.0, 'p25': 61200.0, 'median': 61200.0,
+                    'p75': 61200.0},
+        },
+        ...
+    ]
+    with one entry for every day in week.
+    """
+    if isinstance(data, PresenceStore):
+        return data.weekday_summary(user_ids)
+
+    intervals = [[] for _ in range(7)]
+    starts = [[] for _ in range(7)]
+    ends = [[] for _ in range(7)]
+    for user_id, items in data.iteritems():
+        if user_ids is not None and user_id not in user_ids:
+            continue
+        for date, item in items.iteritems():
+            start = item.start
+            end = item.end
+            intervals[date.weekday()].append(end - start)
+            starts[date.weekday()].append(start)
+            ends[date.weekday()].append(end)
+
+    return [
+        weekday_summary(day, intervals[day], starts[day], ends[day])
+        for day in range(7)
+    ]
+
+
+OCCUPANCY_SLOTS = {'hour': 3600, 'quarter': 900}
+
+
+@derived_from(get_presence_source)
+def get_heatmap(data, user_id=None, slot=3600):
+    """
+    Returns weekday occupancy table of given user, or of all users for
+    None, see `occupancy_table`. Returns None for unknown users.
+    """
+    if user_id is not None and user_id not in data:
+        return None
+    if isinstance(data, PresenceStore):
+        return data.occupancy(user_id, slot)
+
+    users = [user_id] if user_id is not None else data.keys()
+    return occupancy_table(
+        (
+            (date.weekday(), item.start, item.end)
+            for user in users
+            for date, item in data[user].iteritems()
+        ),
+        slot,
+    )
+
+
+def occupancy_table(entries, slot):
+    """
+    Returns presence seconds within consecutive `slot` seconds long parts
+    of every day in week, given (weekday, start, end) entries.
+
+    It creates structure like this:
+    table = [
+        [0, ..., 1255, 3600, 3600, ..., 3592, 0, ...],
+        ...
+    ]
+    with one list of 86400 / slot values for every day in week. Partial
+    first and last slots of every entry are added directly, whole slots in
+    between through a difference array summed up once per weekday.
+    """
+    slots = 86400 // slot
+    # padding slot of every weekday takes differences ending at midnight
+    cells = [[0] * (slots + 1) for _ in range(7)]
+    differences = [[0] * (slots + 1) for _ in range(7)]
+    for weekday, start, end in entries:
+        end = max(start, end)
+        first = start // slot
+        last = end // slot
+        if first == last:
+            cells[weekday][first] += end - start
+            continue
+        cells[weekday][first] += (first + 1) * slot - start
+        cells[weekday][last] += end - last * slot
+        differences[weekday][first + 1] += slot
+        differences[weekday][last] -= slot
+
+    for weekday in range(7):
+        running = 0
+        row = cells[weekday]
+        for idx, difference in enumerate(differences[weekday]):
+            running += difference
+            row[idx] += running
+        del row[slots]
+    return cells
+
+
+@derived_from(get_presence_source)
+def get_day_events(data):
+    """
+    Returns sorted start and end times of presence entries of every day.
+
+    It creates structure like this:
+    events = {
+        'day': [735000, 735001, ...],
+        'starts': [[32400, 34200, ...], [33000, ...], ...],
+        'ends': [[57600, 61200, ...], [59400, ...], ...],
+    }
+    where 'starts' and 'ends' are given for every day ordinal of 'day'.
+    Empty entries are left out. The index is built once per data load.
+    """
+    if isinstance(data, PresenceStore):
+        return data.day_events()
+
+    days = {}
+    for items in data.itervalues():
+        for date, item in items.iteritems():
+            if item.end > item.start:
+                starts, ends = days.setdefault(date.toordinal(), ([], []))
+                starts.append(item.start)
+                ends.append(item.end)
+    day_list = sorted(days)
+    return {
+        'day': day_list,
+        'starts': [sorted(days[day][0]) for day in day_list],
+        'ends': [sorted(days[day][1]) for day in day_list],
+    }
+
+
+def day_events_between(events, first_day, last_day):
+    """
+    Returns (day, starts, ends) events of days between given day
+    ordinals (both inclusive).
+    """
+    low = bisect_left(events['day'], first_day)
+    high = bisect_right(events['day'], last_day, low)
+    return [
+        (events['day'][idx], events['starts'][idx], events['ends'][idx])
+        for idx in range(low, high)
+    ]
+
+
+def occupancy_sweep(starts, ends, step=None):
+    """
+    Returns headcount timeline, peak headcount and its first moment of a
+    day with given sorted start and end times, in a single sweep.
+
+    Timeline holds headcount at every `step` seconds since midnight, it is
+    None without `step`. Entries count from their start until (excluding)
+    their end, peak time is None for days without entries.
+    """
+    timeline = [0] * (86400 // step) if step else []
+    count = peak = sample = 0
+    peak_time = None
+    start_idx = end_idx = 0
+    while end_idx < len(ends):
+        if start_idx < len(starts) and starts[start_idx] < ends[end_idx]:
+            moment = starts[start_idx]
+            change = 1
+            start_idx += 1
+        else:
+            moment = ends[end_idx]
+            change = -1
+            end_idx += 1
+        while sample < len(timeline) and sample * step < moment:
+            timeline[sample] = count
+            sample += 1
+        count += change
+        if count > peak:
+            peak = count
+            peak_time = moment
+    return timeline if step else None, peak, peak_time
+
+
+def weekday_summary(weekday, intervals, starts, ends):
+    """
+    Returns summary of presence entries of single weekday.
+    """
+    intervals = sorted(intervals)
+    return {
+        'weekday': calendar.day_abbr[weekday],
+        'count': len(intervals),
+        'total': sum(intervals),
+        'mean': mean(intervals),
+        'median': percentile(intervals, 50),
+        'start': distribution(sorted(starts)),
+        'end': distribution(sorted(ends)),
+    }
+
+
+def distribution(sorted_items):
+    """
+    Returns mean and quartiles of sorted list.
+    """
+    return {
+        'mean': mean(sorted_items),
+        'p25': percentile(sorted_items, 25),
+        'median': percentile(sorted_items, 50),
+        'p75': percentile(sorted_items, 75),
+    }
+
+
+def percentile(sorted_items, rank):
+    """
+    Returns percentile of sorted list, interpolating between closest ranks.
+
+    Returns zero for empty lists.
+    """
+    if not len(sorted_items):
+        return 0.0
+    position = (len(sorted_items) - 1) * rank / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_items) - 1)
+    return float(
+        sorted_items[lower] +
+        (sorted_items[upper] - sorted_items[lower]) * (position - lower)
+    )
+
+
+def histogram(sorted_items, bin_width):
+    """
+    Returns [bin_start, count] pairs of sorted list, from the first to
+    the last non-empty bin of given width.
+    """
+    if not len(sorted_items):
+        return []
+    result = []
+    bin_start = int(sorted_items[0]) // bin_width * bin_width
+    lower = 0
+    while lower < len(sorted_items):
+        upper = bisect_left(sorted_items, bin_start + bin_width, lower)
+        result.append([bin_start, upper - lower])
+        bin_start += bin_width
+        lower = upper
+    return result
+
+
+def polish_sort_key(text):
+    """
+    Returns key sorting texts in Polish alphabetical order.
+
+    Like Polish locale collation, letters are compared case-insensitively
+    first, ignoring other characters, then whole texts are compared.
+    Accented letters from outside Polish alphabet are ranked as their base
+    letters, e.g. 'É' as 'E'.
+    """
+    text = unicode(text)
+    primary = []
+    for char in text.lower():
+        if not char.isalnum():
+            continue
+        if char not in POLISH_ORDER:
+            base = unicodedata.normalize('NFD', char)[0]
+            if base in POLISH_ORDER:
+                char = base
+        primary.append(POLISH_ORDER.get(char, len(POLISH_ORDER) + ord(char)))
+    return tuple(primary), text
+
+
+@memoize(float('inf'), files=('USERS_XML_LOCAL_FILE',))
+def get_users_data():
+    """
+    Returns users from XML file sorted by name in Polish alphabetical order.
+
+    Users are parsed again only after the XML file changes.
+    """
+    with open(app.config['USERS_XML_LOCAL_FILE'], 'r') as f_xml:
+        tree = etree.parse(f_xml)    # pylint: disable=no-member
+    data_server = tree.find('server')
+    url_prefix = '{0}://{1}:{2}'.format(
+        data_server.find('protocol').text,
+        data_server.find('host').text,
+        data_server.find('port').text
+    )
+    not_sorted_list = [
+        {
+            'user_id': person.get('id'),
+            'name': person.findtext('name'),
+            'avatar': '{0}{1}'.format(url_prefix, person.findtext('avatar')),
+        }
+        for person in tree.findall('./users/user')
+    ]
+    return sorted(
+        not_sorted_list,
+        key=lambda person: polish_sort_key(person['name']),
+    )
+
+
+@derived_from(get_users_data)
+def get_users_data_json(users):
+    """
+    Returns JSON representation of users listing ready to be sent.
+    """
+    return dumps(users)
+
+
+def parse_user_ids(value):
+    """
+    Parses comma separated user ids. Returns None for 'all'.
+
+    Raises ValueError for malformed ids.
+    """
+    if value == 'all':
+        return None
+    return [int(user_id) for user_id in value.split(',') if user_id]
 
 
 def group_by_weekday(items):
@@ -114,10 +1693,8 @@ def group_by_weekday(items):
     Groups presence entries by weekday.
     """
     result = [[], [], [], [], [], [], []]  # one list for every day in week
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for date, item in items.iteritems():
+        result[date.weekday()].append(item.end - item.start)
     return result
 
 
@@ -151,15 +1728,9 @@ def group_start_end_times_by_weekday(items):
         i: {'start': [], 'end': []}
         for i in range(7)
     }
-    for item in items:
-        start = items[item]['start']
-        end = items[item]['end']
-        user_week[item.weekday()]['start'].append(
-            seconds_since_midnight(start)
-        )
-        user_week[item.weekday()]['end'].append(
-            seconds_since_midnight(end)
-        )
+    for date, item in items.iteritems():
+        user_week[date.weekday()]['start'].append(item.start)
+        user_week[date.weekday()]['end'].append(item.end)
 
     return user_week
 
@@ -5,19 +5,25 @@ Defines views.
 
 # pylint: disable=import-error, no-name-in-module
 import calendar
-from flask import redirect
+from datetime import date as Date, datetime
+from flask import Response, abort, redirect, request
 from flask.ext.mako import render_template, exceptions
-from lxml import etree
-import locale
 
+from presence_analyzer import metrics
+from presence_analyzer.backends import get_backend
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
+    DATA_FILES,
+    OCCUPANCY_SLOTS,
+    conditional,
     jsonify,
-    get_data,
-    mean,
-    group_by_weekday,
-    group_start_end_times_by_weekday,
-    median
+    get_users_data_json,
+    histogram,
+    occupancy_sweep,
+    parse_date_range,
+    parse_user_ids,
+    percentile,
+    response_cache_stats,
 )
 
 import logging
@@ -58,125 +64,375 @@ def page_to_display(chosen_template):
 
 
 @app.route('/api/v1/users', methods=['GET'])
+@conditional(*DATA_FILES)
 @jsonify
 def users_view():
     """
     Users listing for dropdown.
     """
-    data = get_data()
     return [
         {'user_id': i, 'name': 'User {0}'.format(str(i))}
-        for i in data.keys()
+        for i in get_backend().user_ids()
     ]
 
 
 @app.route('/api/v1/users_data', methods=['GET'])
-@jsonify
+@conditional('USERS_XML_LOCAL_FILE')
 def users_view_data():
     """
     Users listing for dropdown.
     """
-    with open(app.config['USERS_XML_LOCAL_FILE'], 'r') as f_xml:
-        tree = etree.parse(f_xml)    # pylint: disable=no-member
-    data_server = tree.find('server')
-    url_prefix = '{0}://{1}:{2}'.format(
-        data_server.find('protocol').text,
-        data_server.find('host').text,
-        data_server.find('port').text
-    )
-    locale.setlocale(locale.LC_COLLATE, ('pl', 'utf-8'))
-    not_sorted_list = [
-        {
-            'user_id': person.get('id'),
-            'name': person.findtext('name'),
-            'avatar': '{0}{1}'.format(url_prefix, person.findtext('avatar')),
-        }
-        for person in tree.findall('./users/user')
+    return Response(get_users_data_json(), mimetype='application/json')
+
+
+def _mean_time_weekday(user_stats):
+    """
+    Formats mean presence time grouped by weekday.
+    """
+    return [
+        (calendar.day_abbr[weekday], value)
+        for weekday, value in enumerate(user_stats['mean'])
     ]
-    result = sorted(
-        not_sorted_list,
-        key=lambda person: person['name'],
-        cmp=locale.strcoll
-    )
+
+
+def _presence_weekday(user_stats):
+    """
+    Formats total presence time grouped by weekday.
+    """
+    result = [
+        (calendar.day_abbr[weekday], value)
+        for weekday, value in enumerate(user_stats['sum'])
+    ]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
     return result
 
 
+def _presence_start_end(user_stats):
+    """
+    Formats mean start time and mean end time grouped by weekday.
+    """
+    result = []
+    for day in range(7):
+        result.append([
+            calendar.day_abbr[day],
+            user_stats['start'][day],
+            user_stats['end'][day],
+        ])
+
+    return result
+
+
+def _median_weekday(user_stats):
+    """
+    Formats median presence time grouped by weekday.
+    """
+    return [
+        (calendar.day_abbr[weekday], percentiles[0])
+        for weekday, percentiles in enumerate(
+            _weekday_percentiles(user_stats, [50])
+        )
+    ]
+
+
+def _weekday_percentiles(user_stats, ranks):
+    """
+    Returns given percentiles of presence time for every weekday.
+    """
+    return [
+        [percentile(intervals, rank) for rank in ranks]
+        for intervals in user_stats['intervals']
+    ]
+
+
+WEEKDAY_STATISTICS = {
+    'mean_time_weekday': _mean_time_weekday,
+    'presence_weekday': _presence_weekday,
+    'presence_start_end': _presence_start_end,
+    'median_weekday': _median_weekday,
+}
+
+# statistics formatted from sorted presence intervals
+INTERVAL_STATISTICS = frozenset(['median_weekday'])
+
+
+def _date_range():
+    """
+    Returns day ordinals of requested `from`/`to` range, None without one.
+
+    Aborts with 400 Bad Request for malformed dates.
+    """
+    try:
+        return parse_date_range(request.args)
+    except ValueError:
+        abort(400)
+
+
+def _user_statistic(statistic, user_id):
+    """
+    Returns formatted statistic of given user or 'no_data'.
+
+    Optional `from` and `to` query arguments (YYYY-MM-DD, both inclusive)
+    limit the statistic to entries of a date range.
+    """
+    user_stats = get_backend().weekday_stats(
+        user_id, _date_range(), single_user=True,
+        with_intervals=statistic in INTERVAL_STATISTICS,
+    )
+    if user_stats is None:
+        log.debug('User %s not found!', user_id)
+        return 'no_data'
+
+    return WEEKDAY_STATISTICS[statistic](user_stats)
+
+
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@conditional(*DATA_FILES)
 @jsonify
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return 'no_data'
-
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-    return result
+    return _user_statistic('mean_time_weekday', user_id)
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@conditional(*DATA_FILES)
 @jsonify
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return 'no_data'
-
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return _user_statistic('presence_weekday', user_id)
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@conditional(*DATA_FILES)
 @jsonify
 def presence_start_end_view(user_id):
     """
     Returns mean start time and mean end time.
     """
-    data = get_data()
-    if user_id not in data:
+    return _user_statistic('presence_start_end', user_id)
+
+
+@app.route('/api/v1/median_weekday/<int:user_id>', methods=['GET'])
+@conditional(*DATA_FILES)
+@jsonify
+def median_weekday_view(user_id):
+    """
+    Returns median presence time of given user grouped by weekday.
+    """
+    return _user_statistic('median_weekday', user_id)
+
+
+@app.route('/api/v1/percentiles_weekday/<int:user_id>', methods=['GET'])
+@conditional(*DATA_FILES)
+@jsonify
+def percentiles_weekday_view(user_id):
+    """
+    Returns percentiles of presence time of given user grouped by weekday.
+
+    Percentiles are given as comma separated `percentiles` query parameter
+    (10,25,50,75,90 by default). With `bin_width` (in seconds) histogram
+    of presence time is returned too. Like other statistics, it can be
+    limited to `from`/`to` date range.
+    """
+    try:
+        ranks = [
+            float(rank)
+            for rank in request.args.get(
+                'percentiles', '10,25,50,75,90'
+            ).split(',')
+        ]
+        bin_width = request.args.get('bin_width')
+        if bin_width is not None:
+            bin_width = int(bin_width)
+    except ValueError:
+        abort(400)
+    if not all(0 <= rank <= 100 for rank in ranks) or \
+            bin_width is not None and bin_width <= 0:
+        abort(400)
+
+    user_stats = get_backend().weekday_stats(
+        user_id, _date_range(), single_user=True, with_intervals=True,
+    )
+    if user_stats is None:
         log.debug('User %s not found!', user_id)
         return 'no_data'
 
-    week = group_start_end_times_by_weekday(data[user_id])
-
     result = []
-    for day in week:
-        starts = mean(week[day]['start'])
-        ends = mean(week[day]['end'])
-        result.append([calendar.day_abbr[day], starts, ends])
+    for day, values in enumerate(_weekday_percentiles(user_stats, ranks)):
+        weekday = {
+            'weekday': calendar.day_abbr[day],
+            'count': user_stats['count'][day],
+            'percentiles': dict(
+                ('{0:g}'.format(rank), value)
+                for rank, value in zip(ranks, values)
+            ),
+        }
+        if bin_width is not None:
+            weekday['histogram'] = histogram(
+                user_stats['intervals'][day], bin_width,
+            )
+        result.append(weekday)
+    return result
+
 
+@app.route('/api/v1/bulk/<statistic>', methods=['GET'])
+@conditional(*DATA_FILES)
+@jsonify
+def bulk_view(statistic):
+    """
+    Returns chosen statistic of many users at once.
+
+    Users are given as comma separated `user_ids` query parameter, all
+    users are returned when it is missing or equal to 'all'. Result maps
+    user ids to the same values as the single user view returns, `from`
+    and `to` date range is supported too.
+    """
+    if statistic not in WEEKDAY_STATISTICS:
+        abort(404)
+    try:
+        user_ids = parse_user_ids(request.args.get('user_ids', 'all'))
+    except ValueError:
+        abort(400)
+
+    backend = get_backend()
+    if user_ids is None:
+        user_ids = backend.user_ids()
+    format_stats = WEEKDAY_STATISTICS[statistic]
+    result = {}
+    for user_id, stats in backend.bulk_weekday_stats(
+            user_ids, _date_range(),
+            with_intervals=statistic in INTERVAL_STATISTICS).iteritems():
+        result[user_id] = format_stats(stats) if stats is not None \
+            else 'no_data'
     return result
 
 
-@app.route('/api/v1/median_weekday/<int:user_id>', methods=['GET'])
+@app.route('/api/v1/group_weekday', methods=['GET'])
+@conditional(*DATA_FILES)
 @jsonify
-def median_weekday_view(user_id):
+def group_weekday_view():
     """
-    Returns mean presence time of given user grouped by weekday.
+    Returns weekday statistics of the whole organisation or group of users.
+
+    Users are given as comma separated `user_ids` query parameter, all
+    users are taken into account when it is missing or equal to 'all'.
+    """
+    try:
+        user_ids = parse_user_ids(request.args.get('user_ids', 'all'))
+    except ValueError:
+        abort(400)
+
+    if user_ids is not None:
+        user_ids = frozenset(user_ids)
+    return get_backend().group_weekday_summary(user_ids)
+
+
+def _heatmap(user_id):
     """
-    data = get_data()
-    if user_id not in data:
+    Returns weekday occupancy table of user (all users for None) in
+    requested `resolution`: 'hour' (default) or 'quarter' of hour.
+    """
+    slot = OCCUPANCY_SLOTS.get(request.args.get('resolution', 'hour'))
+    if slot is None:
+        abort(400)
+    table = get_backend().heatmap(user_id, slot)
+    if table is None:
         log.debug('User %s not found!', user_id)
         return 'no_data'
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], median(intervals))
-        for weekday, intervals in enumerate(weekdays)
+    return [
+        [calendar.day_abbr[day], values]
+        for day, values in enumerate(table)
     ]
+
+
+@app.route('/api/v1/heatmap/<int:user_id>', methods=['GET'])
+@conditional(*DATA_FILES)
+@jsonify
+def heatmap_view(user_id):
+    """
+    Returns presence seconds of given user within every hour (or quarter
+    of hour) of every day in week.
+    """
+    return _heatmap(user_id)
+
+
+@app.route('/api/v1/heatmap', methods=['GET'])
+@conditional(*DATA_FILES)
+@jsonify
+def group_heatmap_view():
+    """
+    Returns presence seconds of all users within every hour (or quarter
+    of hour) of every day in week.
+    """
+    return _heatmap(None)
+
+
+@app.route('/api/v1/occupancy/<day>', methods=['GET'])
+@conditional(*DATA_FILES)
+@jsonify
+def occupancy_view(day):
+    """
+    Returns office headcount at every minute of given day (YYYY-MM-DD),
+    its peak and the first second since midnight the peak was reached.
+    """
+    try:
+        day = datetime.strptime(day, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+    events = get_backend().day_events(day.toordinal(), day.toordinal())
+    starts, ends = events[0][1:] if events else ([], [])
+    timeline, peak, peak_time = occupancy_sweep(starts, ends, 60)
+    return {
+        'date': day.isoformat(),
+        'timeline': timeline,
+        'peak': peak,
+        'peak_time': peak_time,
+    }
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@conditional(*DATA_FILES)
+@jsonify
+def occupancy_peaks_view():
+    """
+    Returns peak office headcount of every day with presence entries,
+    optionally limited to `from`/`to` date range.
+    """
+    date_range = _date_range() or (
+        Date.min.toordinal(), Date.max.toordinal(),
+    )
+    result = []
+    for day, starts, ends in get_backend().day_events(*date_range):
+        _, peak, peak_time = occupancy_sweep(starts, ends)
+        result.append({
+            'date': Date.fromordinal(day).isoformat(),
+            'peak': peak,
+            'peak_time': peak_time,
+        })
     return result
+
+
+@app.route('/api/v1/cache_stats', methods=['GET'])
+@jsonify
+def cache_stats_view():
+    """
+    Returns response cache statistics.
+    """
+    return response_cache_stats()
+
+
+@app.route('/api/v1/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns request latency, cache and CSV parsing metrics in Prometheus
+    text format.
+    """
+    return Response(
+        metrics.render(), mimetype='text/plain; version=0.0.4',
+    )